@@ -0,0 +1,126 @@
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from params import PARAMS
+
+LOCK = threading.Lock()
+SESSION = None
+PID = None
+STATS = {}
+QUOTAS = {}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class ThrottledException(Exception):
+    pass
+
+
+class QuotaException(Exception):
+    pass
+
+
+# the errors a request can fail with after its retries
+REQUEST_ERRORS = (requests.RequestException, ThrottledException)
+
+
+# AlphaVantage answers over its limit with a 200 and a JSON note
+def is_alphavantage_throttled(data):
+    return type(data) is dict and 'Note' in data
+
+
+# one keep-alive session per process, pooling as many connections as there are
+# download workers
+def get_session():
+    global SESSION, PID
+    with LOCK:
+        if PID != os.getpid():
+            SESSION = None
+            PID = os.getpid()
+        if SESSION is None:
+            SESSION = requests.Session()
+            size = max(PARAMS['download']['workers'], 1)
+            adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+            SESSION.mount('http://', adapter)
+            SESSION.mount('https://', adapter)
+        return SESSION
+
+
+def reset():
+    global SESSION
+    with LOCK:
+        if SESSION is not None and PID == os.getpid():
+            SESSION.close()
+        SESSION = None
+        STATS.clear()
+
+
+# { endpoint: { requests, retries, failures, seconds } }, seconds being the time
+# spent waiting on responses
+def get_stats():
+    with LOCK:
+        return {endpoint: dict(stats) for endpoint, stats in STATS.items()}
+
+
+def record(endpoint, **counts):
+    with LOCK:
+        stats = STATS.setdefault(endpoint, {'requests': 0, 'retries': 0, 'failures': 0, 'seconds': 0.0})
+        for key, value in counts.items():
+            stats[key] += value
+
+
+# reserve() is called before every request to the endpoint, retries included,
+# and raises QuotaException once none are left, or the quota is removed with None
+def set_quota(endpoint, reserve):
+    with LOCK:
+        if reserve:
+            QUOTAS[endpoint] = reserve
+        else:
+            QUOTAS.pop(endpoint, None)
+
+
+# full jitter, a random wait up to the exponentially growing cap
+def get_backoff(attempt):
+    options = PARAMS['client']
+    return random.uniform(0, min(options['max_backoff'], options['backoff'] * 2 ** attempt))
+
+
+# gets the url on the shared session and returns parse(response), retrying
+# connection errors, throttling statuses and results is_throttled holds for,
+# and reserving the endpoint's quota and acquiring the limiter before every
+# attempt since each one counts
+def get(endpoint, url, parse=None, is_throttled=None, limiter=None, **kwargs):
+    retries = PARAMS['client']['retries']
+    for attempt in range(retries + 1):
+        if attempt:
+            record(endpoint, retries=1)
+            time.sleep(get_backoff(attempt - 1))
+        reserve = QUOTAS.get(endpoint)
+        if reserve:
+            reserve()
+        if limiter:
+            limiter.acquire()
+        start = time.monotonic()
+        try:
+            response = get_session().get(url, timeout=PARAMS['client']['timeout'], **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            record(endpoint, requests=1, seconds=time.monotonic() - start)
+            error = e
+            continue
+        record(endpoint, requests=1, seconds=time.monotonic() - start)
+        if response.status_code in RETRY_STATUSES:
+            error = ThrottledException('%s responded %s' % (endpoint, response.status_code))
+            continue
+        result = parse(response) if parse else response
+        if is_throttled and is_throttled(result):
+            error = ThrottledException('%s is throttling requests' % endpoint)
+            continue
+        return result
+    record(endpoint, failures=1)
+    raise error
+
+
+def get_json(endpoint, url, is_throttled=None, limiter=None, **kwargs):
+    return get(endpoint, url, lambda response: response.json(), is_throttled, limiter, **kwargs)
@@ -1,4 +1,5 @@
 from utility import *
+from client import QuotaException
 import traceback
 import os
 
@@ -14,8 +15,9 @@ class Data:
         self.path = None
         self.data = None
         self.get_path()
-        self.make_path()
-        self.write_params()
+        if not os.path.exists(self.get_params_path()):
+            self.make_path()
+            self.write_params()
         self.data = self.get_data()
 
     def data_error_msg(self):
@@ -31,16 +33,20 @@ class Data:
                         raise DataException(self.data_error_msg())
                     self.write_data()
             return self.data
-        except Exception:
-            raise DataException(traceback.format_exc() + '\n' + self.data_error_msg())
+        except QuotaException:
+            raise
+        except Exception as e:
+            raise DataException(traceback.format_exc() + '\n' + self.data_error_msg()) from e
 
     def get_base_path(self):
         if not self.path:
-            file_name = shorten_path(encrypt_dict(self.params))
-            cwd = os.getcwd()
-            self.path = os.path.join(cwd, PARAMS['data_folder'], self.get_folder(), file_name)
+            self.path = get_data_path(self.get_folder(), self.get_key_params())
         return self.path
 
+    # the params which identify the data and name its folder
+    def get_key_params(self):
+        return self.params
+
     def get_path(self, *paths):
         return os.path.join(self.get_base_path(), *paths)
 
@@ -69,3 +75,24 @@ class Data:
 
     def write_data(self):
         raise NotImplementedError()
+
+
+# the folder the data with the key params is in, whether or not it was made yet
+def get_data_path(folder, key_params):
+    folder = os.path.join(os.getcwd(), PARAMS['data_folder'], folder)
+    path = os.path.join(folder, fingerprint(key_params))
+    if not os.path.exists(path):
+        migrate_path(os.path.join(folder, get_legacy_name(key_params)), path)
+    return path
+
+
+# folders used to be named by the sha1 of the encrypted params
+def get_legacy_name(params):
+    return shorten_path(encrypt_dict(params))
+
+
+def migrate_path(legacy_path, path):
+    try:
+        os.rename(legacy_path, path)
+    except OSError:
+        pass
@@ -0,0 +1,88 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utility import *
+
+LOCK = threading.Lock()
+LIMITER = None
+EXECUTOR = None
+PID = None
+
+
+# token bucket shared by every thread making API requests
+class RateLimiter:
+
+    def __init__(self, requests_per_minute, burst=1):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# forked processes start with their own limiter and pool
+def check_process():
+    global LIMITER, EXECUTOR, PID
+    if PID != os.getpid():
+        LIMITER = None
+        EXECUTOR = None
+        PID = os.getpid()
+
+
+def get_limiter():
+    global LIMITER
+    with LOCK:
+        check_process()
+        if LIMITER is None:
+            LIMITER = RateLimiter(PARAMS['download']['requests_per_minute'],
+                                  PARAMS['download']['burst'])
+        return LIMITER
+
+
+# requests run on one pool so at most workers requests are in flight at once
+def get_executor():
+    global EXECUTOR
+    with LOCK:
+        check_process()
+        if EXECUTOR is None:
+            EXECUTOR = ThreadPoolExecutor(max_workers=PARAMS['download']['workers'])
+        return EXECUTOR
+
+
+def reset():
+    global LIMITER, EXECUTOR
+    with LOCK:
+        check_process()
+        if EXECUTOR is not None:
+            EXECUTOR.shutdown()
+        LIMITER = None
+        EXECUTOR = None
+
+
+# yields fn(item) for every item in the order the requests complete
+def download_map(fn, items):
+    futures = [get_executor().submit(fn, item) for item in items]
+    for future in as_completed(futures):
+        yield future.result()
+
+
+# runs fn(item) for every item on its own pool, so that callers which wait on
+# download_map never block the request workers
+def map_concurrently(fn, items):
+    items = list(items)
+    if len(items) < 2:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=PARAMS['download']['workers']) as executor:
+        return list(executor.map(fn, items))
@@ -0,0 +1,84 @@
+import numpy as np
+from store import INDEX_DTYPE, dict_to_arrays, slice_store, store_to_dict, to_float
+from utility import *
+
+
+# rows of float columns on a sorted int32 day number index, which slices by date
+# and joins on the index with binary searches instead of walking date strings
+class SymbolFrame:
+
+    def __init__(self, index, columns):
+        self.index = np.asarray(index, dtype=INDEX_DTYPE)
+        self.columns = columns
+
+    # from { date: { column: value } }
+    @classmethod
+    def from_dict(cls, data):
+        return cls(*dict_to_arrays(data))
+
+    # from { date: value }
+    @classmethod
+    def from_series(cls, data, column):
+        dates = sorted(data)
+        index = dates_to_days(dates).astype(INDEX_DTYPE)
+        values = np.array([to_float(data[date]) for date in dates], dtype=np.float64)
+        return cls(index, {column: values})
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_dates(self):
+        return [day_to_date(day) for day in self.index.tolist()]
+
+    def get_columns(self):
+        return list(self.columns)
+
+    def get_series(self, column):
+        return self.columns[column]
+
+    # rows as a matrix with the columns in the order given
+    def get_matrix(self, columns=None):
+        columns = self.get_columns() if columns is None else columns
+        if not columns:
+            return np.zeros((len(self), 0))
+        return np.column_stack([self.columns[column] for column in columns])
+
+    def take(self, rows):
+        return SymbolFrame(self.index[rows], {column: values[rows] for column, values in self.columns.items()})
+
+    def select(self, columns):
+        return SymbolFrame(self.index, {column: self.columns[column] for column in columns if column in self.columns})
+
+    def rename(self, names):
+        return SymbolFrame(self.index, {names.get(column, column): values for column, values in self.columns.items()})
+
+    # inclusive, returns views of the frame's arrays
+    def slice(self, start, end):
+        if not (start and end):
+            return self
+        return SymbolFrame(*slice_store(self.index, self.columns, start, end))
+
+    # rows with a value in every column
+    def dropna(self):
+        if not self.columns:
+            return self
+        complete = ~np.any([np.isnan(values) for values in self.columns.values()], axis=0)
+        return self if complete.all() else self.take(complete)
+
+    # positions of the days in the index and whether each one is there
+    def locate(self, index):
+        positions = np.searchsorted(self.index, index)
+        found = positions < len(self.index)
+        found[found] = self.index[positions[found]] == np.asarray(index)[found]
+        return positions, found
+
+    # the rows of both frames on the days they share
+    def join(self, other):
+        positions, found = other.locate(self.index)
+        return self.take(found), other.take(positions[found])
+
+    def to_dict(self):
+        return store_to_dict(self.index, self.columns)
+
+    def to_series(self, column):
+        return {date: value for date, value in zip(self.get_dates(), self.columns[column].tolist())}
@@ -5,6 +5,7 @@ import neural
 from data import Data
 from optimal import OptimalTrades
 from symbol import SymbolData, SymbolCloseData
+from frame import SymbolFrame
 from utility import *
 
 
@@ -69,36 +70,32 @@ class OptimalTradesGraph(Graph):
 
 
 def graph_symbol_data(symbol, options_list, start, end):
-    data = SymbolData(symbol=symbol, options_list=options_list, start=start, end=end).get_data()
-    columns = get_columns(data)
-    data_list = [extract_column(col, data) for col in columns]
-
-    xys = dicts_to_xys(data_list)
+    data = SymbolData(symbol=symbol, options_list=options_list, start=start, end=end).get_frame()
+    x = np.arange(len(data))
 
     fig = plt.figure()
-    for x, y in xys:
-        plt.plot(x, y)
+    for column in data.get_columns():
+        plt.plot(x, data.get_series(column))
 
     return fig
 
 
 def graph_optimal_trades(symbol, start, end, tolerance):
-    prices = SymbolCloseData(symbol=symbol, start=start, end=end).get_data()
+    prices = SymbolCloseData(symbol=symbol, start=start, end=end).get_frame()
     trades = OptimalTrades(symbol=symbol, start=start, end=end, tolerance=tolerance).get_data()
+    trades = SymbolFrame.from_series(trades, 'trade')
 
-    buy_sizes = {k: 20 * v for k, v in trades.items() if v > 0}
-    buy_prices = {k: prices[k] for k in buy_sizes}
-    sell_sizes = {k: -20 * v for k, v in trades.items() if v < 0}
-    sell_prices = {k: prices[k] for k in sell_sizes}
-
-    (xp, yp), (xb, ybp), (_, ybs), (xs, ysp), (_, yss) = dicts_to_xys([
-        prices, buy_prices, buy_sizes, sell_prices, sell_sizes
-    ])
+    close = prices.get_series('close')
+    positions, found = prices.locate(trades.index)
+    positions = positions[found]
+    sizes = 20 * trades.get_series('trade')[found]
+    buys = positions[sizes > 0]
+    sells = positions[sizes < 0]
 
     fig = plt.figure()
-    plt.plot(xp, yp)
-    plt.scatter(xb, ybp, s=ybs, c='g')
-    plt.scatter(xs, ysp, s=yss, c='r')
+    plt.plot(np.arange(len(prices)), close)
+    plt.scatter(buys, close[buys], s=sizes[sizes > 0], c='g')
+    plt.scatter(sells, close[sells], s=-sizes[sizes < 0], c='r')
 
     return fig
 
@@ -0,0 +1,229 @@
+import fcntl
+import threading
+import client
+import symbol
+from symbol import SymbolData, get_symbol_folder, get_symbol_options, read_symbol_store, get_old_columns
+from download import map_concurrently
+from utility import *
+
+JOBS_FILE = 'jobs.json'
+LOCK = threading.Lock()
+NEEDED = 1
+MAX_FAILURES = 3
+QUOTA_DAYS = 7
+
+
+# a job downloads one symbol's options, in full or only the rows after the stored
+# ones when incremental, and higher priority jobs run first
+def make_job(symbol, options, incremental, priority=0):
+    return {'symbol': symbol, 'options': options, 'incremental': incremental,
+            'priority': priority, 'failures': 0}
+
+
+def get_job_key(job):
+    return job['symbol'], json.dumps(job['options'], sort_keys=True)
+
+
+def get_jobs_path():
+    return os.path.join(os.getcwd(), PARAMS['data_folder'], JOBS_FILE)
+
+
+# the queue and the requests used each day are kept in one file, changed under a
+# lock shared with other processes using the data folder
+def locked(fn):
+    path = get_jobs_path()
+    make_path(path)
+    with LOCK, open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            state = read_state(path)
+            result = fn(state)
+            write_state(path, state)
+            return result
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def read_state(path):
+    try:
+        with open(path, 'r') as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return {'jobs': [], 'used': {}}
+
+
+def write_state(path, state):
+    with open(path + '.tmp', 'w') as fh:
+        json.dump(state, fh)
+    os.replace(path + '.tmp', path)
+
+
+# the jobs that get the symbol's options_list columns, and with refresh the
+# rows after its stored ones, planned without downloading anything
+def get_symbol_jobs(s, options_list, refresh, priority=0):
+    options, _ = get_symbol_options(read_symbol_store(get_symbol_folder(s)), options_list, refresh)
+    return [make_job(s, o, incremental, priority) for incremental in (False, True) for o in options[incremental]]
+
+
+# queues the downloads the symbols need, raising the priority of queued ones,
+# and returns the number of jobs queued for them
+def add_jobs(symbols, options_list, refresh=False, priority=0):
+    jobs = []
+    for s in remove_duplicates(symbols):
+        jobs += get_symbol_jobs(s, options_list, refresh, priority)
+    return locked(lambda state: merge_jobs(state, jobs))
+
+
+def merge_jobs(state, jobs):
+    queued = {get_job_key(job): job for job in state['jobs']}
+    for job in jobs:
+        key = get_job_key(job)
+        if key in queued:
+            queued[key]['incremental'] = queued[key]['incremental'] and job['incremental']
+            queued[key]['priority'] = max(queued[key]['priority'], job['priority'])
+        else:
+            queued[key] = job
+            state['jobs'].append(job)
+    return len(jobs)
+
+
+def get_jobs(symbols=None):
+    jobs = locked(lambda state: state['jobs'])
+    return [job for job in jobs if symbols is None or job['symbol'] in symbols]
+
+
+def clear_jobs():
+    locked(lambda state: state['jobs'].clear())
+
+
+def get_used(state):
+    return state['used'].get(Date.today().isoformat(), 0)
+
+
+def add_used(state, requests):
+    today = Date.today().isoformat()
+    state['used'][today] = get_used(state) + requests
+    for day in sorted(state['used'])[:-QUOTA_DAYS]:
+        del state['used'][day]
+
+
+def get_quota_left():
+    return locked(lambda state: max(PARAMS['download']['daily_quota'] - get_used(state), 0))
+
+
+# takes one of today's requests before it is made, so that retries, fallbacks
+# and the daily data a job also needs all count against the quota
+def reserve_request():
+    if not locked(take_request):
+        raise client.QuotaException('Used the quota of %s requests today' % PARAMS['download']['daily_quota'])
+
+
+def take_request(state):
+    if get_used(state) >= PARAMS['download']['daily_quota']:
+        return False
+    add_used(state, 1)
+    return True
+
+
+# runs queued jobs, only the symbols' when given, by priority until there are
+# none left or today's quota is used, one thread per symbol so that no two jobs
+# write the same store at once, and saves the queue after every job so that the
+# next run resumes where this one stopped, returning the number of jobs done
+def run_jobs(symbols=None):
+    client.set_quota('alphavantage', reserve_request)
+    try:
+        done = 0
+        while True:
+            jobs = locked(lambda state: take_jobs(state, PARAMS['download']['daily_quota'] - get_used(state),
+                                                  symbols))
+            if not jobs:
+                return done
+            groups = [[job for job in jobs if job['symbol'] == s]
+                      for s in remove_duplicates([job['symbol'] for job in jobs])]
+            counts = map_concurrently(run_symbol_jobs, groups)
+            if not any(counts):
+                return done
+            done += sum(counts)
+    finally:
+        client.set_quota('alphavantage', None)
+
+
+# every job takes at least one request, so no more are taken than are left
+def take_jobs(state, count, symbols=None):
+    jobs = sorted(state['jobs'], key=lambda job: -job['priority'])
+    return [job for job in jobs if job['failures'] < MAX_FAILURES
+            and (symbols is None or job['symbol'] in symbols)][:max(count, 0)]
+
+
+# a job stopped by the quota stays queued as it was for the next run
+def run_symbol_jobs(jobs):
+    done = 0
+    for job in sorted(jobs, key=lambda job: job['options'] != symbol.DAILY_OPTIONS):
+        try:
+            run_job(job)
+            failed = False
+        except client.QuotaException:
+            return done
+        except Exception as e:
+            log('Failed to download %s: %s' % (job['symbol'], get_error_message(e)), force=True)
+            failed = True
+        locked(lambda state: finish_job(state, job, failed))
+        done += not failed
+    return done
+
+
+def finish_job(state, job, failed):
+    key = get_job_key(job)
+    queued = next((j for j in state['jobs'] if get_job_key(j) == key), None)
+    if queued is None:
+        return
+    if failed and queued['failures'] + 1 < MAX_FAILURES:
+        queued['failures'] += 1
+    else:
+        state['jobs'].remove(queued)
+
+
+# the job's data is downloaded when it is missing from the store, and the newer
+# rows when it is incremental and the data is still old
+def run_job(job):
+    options = job['options']
+    data = SymbolData(symbol=job['symbol'], options_list=[options])
+    if job['incremental']:
+        columns = {column_id: data.columns[column_id] for _, column_id in get_column_ids(options)
+                   if column_id in data.columns}
+        if get_old_columns(data.index, columns):
+            data.download_data([options], incremental=True)
+
+
+def add_args(parser):
+    symbol.add_symbol_args(parser)
+    parser.add_argument('-o', '--options', type=str, nargs='+',
+                        help='indices of data_options in params.py')
+    parser.add_argument('-r', '--refresh', action='store_true', help='queue downloads of newer rows')
+    parser.add_argument('--priority', type=int, default=0, help='priority of the queued downloads')
+    parser.add_argument('--run', action='store_true', help='download queued data within the daily quota')
+    parser.add_argument('--clear', action='store_true', help='empty the queue')
+
+
+def handle_args(args, parser):
+    if args.symbols or args.screener:
+        if not args.options:
+            parser.error('-o/--options is required with symbols to queue')
+        symbol.handle_symbol_args(args, parser)
+        symbol.handle_options_args(args, parser)
+
+
+def main():
+    args = parse_args('Queue symbol data downloads.', add_args, handle_args)
+    if args.clear:
+        clear_jobs()
+    if args.symbols:
+        log('Queued %s downloads' % add_jobs(args.symbols, args.options_list, args.refresh, args.priority),
+            force=args.print)
+    if args.run:
+        log('Downloaded %s' % run_jobs(), force=args.print)
+    log('%s downloads queued, %s requests left today' % (len(get_jobs()), get_quota_left()), force=args.print)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,22 @@
 import logging
-from subprocess import call
-from kur.loggers import BinaryLogger
-from kur import Kurfile
-from kur.engine import JinjaEngine
-from kur.utils import DisableLogging
-
 import preprocess
 from analysis import get_accuracy, get_average_distance
 from utility import *
-from data import Data
+from data import Data, DataException, get_data_path
+from symbol import SymbolData
+from download import map_concurrently
+import train
+
+BATCH_SIZE = 1024
+TRAIN_PARAMS = ['batch_size', 'patience']
+# the values networks were trained with before they were params
+LEGACY_TRAIN_PARAMS = {'batch_size': 32, 'patience': 5}
 
 
 class NeuralNetwork(Data):
 
     def __init__(self, **params):
+        params = add_train_params(params)
         self.training = params['training']
         self.validation = params['validation']
         self.evaluation = params['evaluation']
@@ -24,98 +27,162 @@ class NeuralNetwork(Data):
         self.nodes = params.get('nodes', 128)
         self.activation = params.get('activation', 'tanh')
         self.loss = params.get('loss', 'mean_squared_error')
+        self.windowed = params.get('windowed', False)
+        self.batch_size = params.get('batch_size', PARAMS['train']['batch_size'])
+        self.patience = params.get('patience', PARAMS['train']['patience'])
         self.part_data = None
+        self.model = None
         super().__init__(**params)
 
     def get_folder(self):
         return 'neural'
 
+    # networks train.py trained before their inputs order was kept are trained again
     def read_data(self):
-        return read_pickle(self.get_data_path())
+        data = read_pickle(self.get_data_path())
+        if data and 'inputs' not in data and os.path.exists(self.get_weights_path()):
+            return
+        return data
 
+    # the checkpoint is only needed until the finished data is written
     def write_data(self):
         write_pickle(self.get_data_path(), self.get_data())
+        if os.path.exists(self.get_checkpoint_path()):
+            os.remove(self.get_checkpoint_path())
 
     def get_data_path(self):
         return self.get_path('data.pkl')
 
+    # written by kur for networks trained before train.py
     def get_model_path(self):
         return self.get_path('model.yml')
 
+    def get_weights_path(self):
+        return self.get_path('weights.npz')
+
+    def get_checkpoint_path(self):
+        return self.get_path('checkpoint.pkl')
+
     def get_new_data(self):
         log('Training neural network...')
-        self.make_model()
-        return train_neural_network(self.get_path())
-
-    def make_model(self):
-        make_path(self.get_model_path())
-        with open(self.get_model_path(), 'w') as fh:
-            fh.write(self.get_model())
+        part_data = self.get_part_data()
+        network, data = train.train(part_data.get_data(), part_data.get_shape(), self.epochs, self.nodes,
+                                    self.activation, self.loss, self.batch_size,
+                                    self.get_checkpoint_path(), self.patience)
+        network.save(self.get_weights_path())
+        self.model = network
+        output = data['output']
+        return {**data, 'inputs': part_data.get_inputs(), 'accuracy': get_accuracy(output),
+                'average_distance': get_average_distance(output)}
+
+    # the (column, prior) order of the inputs the network was trained on, which
+    # for networks kur trained is the order before the schema's column ids
+    def get_input_order(self):
+        inputs = self.get_data().get('inputs')
+        if inputs is None:
+            columns = preprocess.get_input_columns(self.options_list)
+            inputs = preprocess.get_legacy_input_order(columns, self.days, preprocess.get_legacy_names(columns))
+        return inputs
 
     def get_part_data(self):
         if not self.part_data:
             self.part_data = preprocess.NeuralNetworkData(training=self.training, validation=self.validation,
                                                           evaluation=self.evaluation, options_list=self.options_list,
-                                                          days=self.days, tolerance=self.tolerance)
+                                                          days=self.days, tolerance=self.tolerance,
+                                                          **({'windowed': True} if self.windowed else {}))
         return self.part_data
 
-    def get_model(self):
-        folder = self.get_path()
-        part_data = self.get_part_data()
-        training = part_data.get_part_path('training')
-        validation = part_data.get_part_path('validation')
-        evaluation = part_data.get_part_path('evaluation')
-        return make_model(training, validation, evaluation, folder, self.epochs,
-                          self.nodes, self.activation, self.loss, part_data.get_shape())
+    # the trained model, loaded once per instance
+    def load_model(self):
+        if self.model is None:
+            if os.path.exists(self.get_weights_path()):
+                self.model = train.Network.load(self.get_weights_path())
+            else:
+                self.model = KurModel(self.get_model_path(), self.get_path('weights'))
+        return self.model
 
     def predict(self, data):
-        kurfile = Kurfile(self.get_model_path(), JinjaEngine())
+        return self.predict_batch(np.array([data]))[0]
+
+    # a prediction per row of the matrix, evaluated batch_size rows at a time
+    def predict_batch(self, matrix, batch_size=BATCH_SIZE):
+        matrix = np.asarray(matrix)
+        if not len(matrix):
+            return np.zeros(0)
+        model = self.load_model()
+        return np.concatenate([model.predict(matrix[start:start + batch_size])
+                               for start in range(0, len(matrix), batch_size)])
+
+    # the symbols and dates of the (symbol, date) pairs, each sorted, and a
+    # symbols x dates table of their predictions, NaN where a symbol has no
+    # inputs for a date
+    def predict_table(self, pairs, batch_size=BATCH_SIZE):
+        symbols = sorted({s for s, _ in pairs})
+        dates = sorted({date for _, date in pairs})
+        symbol_dates = {s: [] for s in symbols}
+        for s, date in pairs:
+            symbol_dates[s].append(date)
+        inputs = map_concurrently(lambda s: self.get_inputs(s, symbol_dates[s]), symbols)
+        table = np.full((len(symbols), len(dates)), np.nan)
+        rows, columns = [], []
+        for i, (_, found) in enumerate(inputs):
+            rows += [i] * len(found)
+            columns += found
+        if rows:
+            predictions = self.predict_batch(np.concatenate([matrix for matrix, _ in inputs]), batch_size)
+            table[rows, np.searchsorted(dates, columns)] = predictions
+        return symbols, dates, table
+
+    # the symbols with cached data, the latest complete day of each and the
+    # predictions for those days, read from only the trailing rows
+    def predict_live(self, symbols, batch_size=BATCH_SIZE):
+        symbols, dates, matrix = preprocess.get_live_inputs(symbols, self.options_list, self.days,
+                                                             self.get_input_order())
+        return symbols, dates, self.predict_batch(matrix, batch_size)
+
+    # the symbol's input rows for the dates and the dates they are for
+    def get_inputs(self, symbol, dates):
+        dates = sorted(set(dates))
+        inputs = self.get_input_order()
+        try:
+            frame = SymbolData(symbol=symbol, options_list=self.options_list).get_frame()
+            matrix, found = preprocess.get_symbol_inputs(frame, dates, self.days, inputs)
+        except DataException as e:
+            log_skip(symbol, e)
+            return np.zeros((0, len(inputs))), []
+        return matrix, [date for date, kept in zip(dates, found.tolist()) if kept]
+
+
+# the params with the batch_size and patience of train in PARAMS added when not
+# given, since they change what is trained, except for networks trained before
+# they were params with the values they have, which keep their folders
+def add_train_params(params):
+    params = {**{param: PARAMS['train'][param] for param in TRAIN_PARAMS}, **params}
+    legacy = {k: v for k, v in params.items() if k not in TRAIN_PARAMS}
+    if all(params[param] == LEGACY_TRAIN_PARAMS[param] for param in TRAIN_PARAMS) \
+            and os.path.exists(os.path.join(get_data_path('neural', legacy), 'data.pkl')):
+        return legacy
+    return params
+
+
+# a network kur trained, compiled from the model.yml it was trained with; kur is
+# only imported for these
+class KurModel:
+
+    def __init__(self, model_path, weights_path):
+        from kur import Kurfile
+        from kur.engine import JinjaEngine
+        from kur.utils import DisableLogging
+        kurfile = Kurfile(model_path, JinjaEngine())
         kurfile.parse()
-        model = kurfile.get_model()
+        self.model = kurfile.get_model()
         with DisableLogging(logging.WARNING):
-            model.backend.compile(model)
-        model.restore(self.get_path('weights'))
-        pdf, metrics = model.backend.evaluate(model, data={'in': np.array([data])})
-        prediction = pdf['out'][0][0]
-        return prediction
-
-
-def make_model(training, validation, evaluation, folder, epochs, nodes, activation, loss, shape):
-    with open('model.yml', 'r') as fh:
-        model = fh.read()
-        model = model.replace('TRAINING', training)
-        model = model.replace('VALIDATION', validation)
-        model = model.replace('EVALUATION', evaluation)
-        model = model.replace('WEIGHTS', os.path.join(folder, 'weights'))
-        model = model.replace('LOG', os.path.join(folder, 'log'))
-        model = model.replace('OUTPUT', os.path.join(folder, 'output.pkl'))
-        model = model.replace('EPOCHS', str(epochs))
-        model = model.replace('NODES', str(nodes))
-        model = model.replace('ACTIVATION', activation)
-        model = model.replace('LOSS', loss)
-        model = model.replace('SHAPE', str(shape))
-        return model
-
-
-def train_neural_network(folder):
-    model_path = os.path.join(folder, 'model.yml')
-    log_path = os.path.join(folder, 'log')
-    output_path = os.path.join(folder, 'output.pkl')
-    std_out = None if PARAMS['verbose'] else 'out'
-    call(['kur', 'train', model_path], stdout=stdout)
-    call(['kur', 'evaluate', model_path], stdout=stdout)
-    output = read_pickle(output_path)
-    return {
-        'training_loss': get_loss(log_path, 'training_loss_total'),
-        'validation_loss': get_loss(log_path, 'validation_loss_total'),
-        'output': output,
-        'accuracy': get_accuracy(output),
-        'average_distance': get_average_distance(output)
-    }
-
-
-def get_loss(log_path, path):
-    return BinaryLogger.load_column(log_path, path)
+            self.model.backend.compile(self.model)
+        self.model.restore(weights_path)
+
+    def predict(self, matrix):
+        pdf, metrics = self.model.backend.evaluate(self.model, data={'in': np.asarray(matrix)})
+        return np.asarray(pdf['out'])[:, 0]
 
 
 def add_args(parser):
@@ -128,17 +195,32 @@ def add_args(parser):
                         help='type of activation layer')
     parser.add_argument('--loss', type=str, default='mean_squared_error',
                         help='type of loss function', choices=['mean_squared_error'])
+    parser.add_argument('-b', '--batch_size', type=int,
+                        help='number of rows per training step, %s by default' % PARAMS['train']['batch_size'])
+    parser.add_argument('--patience', type=int,
+                        help='epochs without a lower validation loss to stop after, never when 0, %s by default'
+                             % PARAMS['train']['patience'])
 
 
 def handle_args(args, parser):
     preprocess.handle_args(args, parser)
 
 
+# the train params given, the others left for NeuralNetwork to add
+def get_train_params(args):
+    return {param: getattr(args, param) for param in TRAIN_PARAMS if getattr(args, param) is not None}
+
+
 def main():
     args = parse_args('Create a neural network.', add_args, handle_args)
+    if args.dry_run:
+        return log(preprocess.get_parts_cost(args.parts, args.options_list), force=True)
+    if args.queue and not preprocess.download_queued(args.parts, args.options_list):
+        return
     data = NeuralNetwork(**args.parts, options_list=args.options_list, days=args.days,
                          tolerance=args.tolerance, epochs=args.epochs, nodes=args.nodes,
-                         activation=args.activation, loss=args.loss)
+                         activation=args.activation, loss=args.loss, **get_train_params(args),
+                         **preprocess.get_windowed_params(args))
     log(data.get_data(), force=args.print)
     if args.path:
         log(data.get_path(), force=args.print)
@@ -1,10 +1,12 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
 from data import Data
 from utility import *
+from frame import SymbolFrame
 from symbol import SymbolCloseData, add_symbol_args, handle_symbol_args
 
 BUY = 1
 SELL = -1
+SCAN_LANES = 128
 
 
 class OptimalTrades(Data):
@@ -34,35 +36,46 @@ class OptimalTrades(Data):
 
 
 def get_optimal_trades(symbol, start, end, tolerance):
-    data = SymbolCloseData(symbol=symbol, start=start, end=end).get_data()
+    data = SymbolCloseData(symbol=symbol, start=start, end=end).get_frame()
     return calc_trades(data, tolerance=tolerance)
 
 
 def calc_trades(data, tolerance):
-    dates = sorted(data)
-    prices = [data[date] for date in dates]
+    dates, prices = get_prices(data)
+    prices = prices.tolist()
     trades = optimize_trades(prices, tolerance)
     trades = smooth_trades(trades, prices)
     trade_data = {dates[key]: val for key, val in trades.items()}
     return trade_data
 
 
+# labels the same data for every tolerance in one pass
+def calc_trades_sweep(data, tolerances):
+    dates, prices = get_prices(data)
+    labels = smooth_labels(prices, label_trades(prices, tolerances))
+    return {
+        tolerance: {date: label for date, label in zip(dates, row.tolist()) if label == label}
+        for tolerance, row in zip(tolerances, labels)
+    }
+
+
+# data is either { date: price } or a SymbolFrame with a close column
+def get_prices(data):
+    if type(data) is SymbolFrame:
+        return data.get_dates(), np.asarray(data.get_series('close'), dtype=np.float64)
+    dates = sorted(data)
+    return dates, np.array([data[date] for date in dates], dtype=np.float64)
+
+
 def smooth_trades(trades, prices):
     if len(trades) < 2:
         return trades
 
-    ordered_trades = sorted(trades.items())
-
-    for i, (date, trade) in enumerate(ordered_trades[1:]):
-        last_date = ordered_trades[i][0]
-        if trade == BUY:
-            buy_price = prices[date]
-            sell_price = prices[last_date]
-        else:
-            buy_price = prices[last_date]
-            sell_price = prices[date]
-        for j, price in enumerate(prices[last_date + 1:date]):
-            trades[last_date + 1 + j] = smooth_trade(price, buy_price, sell_price)
+    signals = np.zeros(len(prices), dtype=np.int8)
+    signals[list(trades)] = list(trades.values())
+    labels = smooth_labels(np.asarray(prices, dtype=np.float64), signals)
+    interior = np.flatnonzero((signals == 0) & ~np.isnan(labels))
+    trades.update(zip(interior.tolist(), labels[interior].tolist()))
 
     return trades
 
@@ -71,6 +84,31 @@ def smooth_trade(price, buy_price, sell_price):
     return 1 - 2 * (price - buy_price) / (sell_price - buy_price)
 
 
+# smooths BUY and SELL signals along the last axis into labels between them,
+# leaving NaN before the first and after the last trade
+def smooth_labels(prices, signals):
+    prices, signals = np.broadcast_arrays(np.asarray(prices, dtype=np.float64), signals)
+    shape = signals.shape
+    prices = prices.reshape(-1, shape[-1])
+    signals = signals.reshape(-1, shape[-1])
+    rows = np.arange(len(signals))[:, None]
+    positions = np.arange(shape[-1])
+    traded = signals != 0
+    last = np.maximum.accumulate(np.where(traded, positions, -1), axis=1)
+    upcoming = np.minimum.accumulate(np.where(traded, positions, shape[-1])[:, ::-1], axis=1)[:, ::-1]
+    between = (last >= 0) & (upcoming < shape[-1])
+    last = np.where(between, last, 0)
+    upcoming = np.where(between, upcoming, 0)
+    buying = signals[rows, upcoming] == BUY
+    buy_price = np.where(buying, prices[rows, upcoming], prices[rows, last])
+    sell_price = np.where(buying, prices[rows, last], prices[rows, upcoming])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        labels = smooth_trade(prices, buy_price, sell_price)
+    labels[~between] = np.nan
+    labels[traded] = signals[traded]
+    return labels.reshape(shape)
+
+
 def optimize_trades(prices, tolerance):
     if len(prices) < 2:
         return {}
@@ -127,6 +165,79 @@ def should_buy_first(prices, tolerance):
                 return False
 
 
+# array version of optimize_trades for a batch of price series, labelled for every
+# tolerance at once; prices of shape (..., days) are padded with NaN after their
+# last day, and the result of shape (..., tolerances, days) holds BUY and SELL
+# where optimize_trades would return them and 0 elsewhere
+def label_trades(prices, tolerances):
+    prices = np.asarray(prices, dtype=np.float64)
+    tolerances = np.asarray(tolerances, dtype=np.float64)
+    shape = prices.shape[:-1] + tolerances.shape + prices.shape[-1:]
+    lanes = prices.reshape(prices.shape[:-1] + (1,) * tolerances.ndim + prices.shape[-1:])
+    lanes = np.broadcast_to(lanes, shape).reshape(-1, shape[-1])
+    lane_tolerances = np.broadcast_to(tolerances, shape[:-1]).reshape(-1)
+    if len(lanes) < SCAN_LANES:
+        signals = np.zeros(lanes.shape, dtype=np.int8)
+        for signal, prices, tolerance in zip(signals, lanes, lane_tolerances):
+            trades = optimize_trades(trim_padding(prices).tolist(), float(tolerance))
+            signal[list(trades)] = list(trades.values())
+        return signals.reshape(shape)
+    return scan_trades(lanes, lane_tolerances).reshape(shape)
+
+
+def trim_padding(prices):
+    padding = np.isnan(prices[::-1]).argmin() if len(prices) else 0
+    return prices[:len(prices) - padding]
+
+
+# steps every lane through the optimize_trades state machine together, which
+# only pays for its per-day overhead once there are SCAN_LANES lanes or more
+def scan_trades(prices, tolerances):
+    lanes, days = prices.shape
+    signals = np.zeros((lanes, days), dtype=np.int8)
+    if days < 2:
+        return signals
+    buying = should_buy_first_lanes(prices, tolerances)
+    anchor = prices[:, 0].copy()
+    anchor_index = np.zeros(lanes, dtype=np.intp)
+    for day in range(1, days):
+        price = prices[:, day]
+        price_diff = (price - anchor) / anchor
+        selling = ~buying
+        buy = buying & (price_diff > tolerances)
+        sell = selling & (price_diff < -tolerances)
+        trade = buy | sell
+        move = trade | (buying & (price_diff < 0)) | (selling & (price_diff > 0))
+        if trade.any():
+            traded = np.flatnonzero(trade)
+            signals[traded, anchor_index[traded]] = np.where(buy[traded], BUY, SELL)
+            buying ^= trade
+        if move.any():
+            anchor[move] = price[move]
+            anchor_index[move] = day
+    return signals
+
+
+# should_buy_first only ever compares a price with one of the two before it
+def should_buy_first_lanes(prices, tolerances):
+    lanes, days = prices.shape
+    buying = np.zeros(lanes, dtype=bool)
+    undecided = np.ones(lanes, dtype=bool)
+    delay = np.zeros(lanes, dtype=np.intp)
+    rows = np.arange(lanes)
+    for index in range(days - 1):
+        if not undecided.any():
+            break
+        anchor = prices[rows, index - delay]
+        price_diff = (prices[:, index + 1] - anchor) / anchor
+        up = undecided & (price_diff > tolerances)
+        down = undecided & (price_diff < -tolerances)
+        buying |= up
+        undecided &= ~(up | down)
+        delay = ((-tolerances <= price_diff) & (price_diff < 0)).astype(np.intp)
+    return buying
+
+
 def get_optimal_trades_dict(symbols, start, end, tolerance):
     trades = {}
     for symbol in symbols:
@@ -134,6 +245,11 @@ def get_optimal_trades_dict(symbols, start, end, tolerance):
     return trades
 
 
+def get_optimal_trades_sweep(symbol, start, end, tolerances):
+    data = SymbolCloseData(symbol=symbol, start=start, end=end).get_frame()
+    return calc_trades_sweep(data, tolerances)
+
+
 def add_args(parser):
     add_symbol_args(parser)
     parser.add_argument('-t', '--tolerance', type=float, default=0.01,
@@ -0,0 +1,203 @@
+from data import Data, DataException
+from frame import SymbolFrame
+from store import INDEX, INDEX_DTYPE, read_manifest, write_manifest, read_array, write_array, append_array, get_store_version
+import symbol
+from symbol import get_symbol_data, get_symbol_folder, get_symbol_frame, read_symbol_store, get_cached_symbols
+from download import map_concurrently
+from utility import *
+
+VALUES = 'values.f4'
+VALUES_DTYPE = np.float32
+
+
+# every symbol's data on one shared calendar, stored as a dates x symbols x
+# features float32 file so that new days are appended to the end of it, and
+# read memory mapped as symbols x dates x features with NaN where a symbol has
+# no complete row for a day; symbols of None are those cached when the panel is
+# updated, and with cached set only stored columns are read, never downloaded
+class Panel(Data):
+
+    def __init__(self, **params):
+        self.symbols = params['symbols']
+        self.options_list = params['options_list']
+        self.cached = params.get('cached', False)
+        self.index = None
+        self.values = None
+        super().__init__(**params)
+
+    def get_folder(self):
+        return 'panel'
+
+    def read_data(self):
+        manifest = read_manifest(self.get_path())
+        if manifest:
+            self.load(manifest)
+        return manifest
+
+    def write_data(self):
+        # the panel is written by get_new_data and update
+        pass
+
+    def get_new_data(self):
+        log('Building panel...')
+        return self.update()
+
+    def load(self, manifest):
+        shape = (manifest['length'], len(manifest['symbols']), len(manifest['columns']))
+        self.index = read_array(self.get_path(INDEX), INDEX_DTYPE, manifest['length'])
+        if manifest['length']:
+            self.values = np.memmap(self.get_path(VALUES), dtype=VALUES_DTYPE, mode='r', shape=shape)
+        else:
+            self.values = np.zeros(shape, dtype=VALUES_DTYPE)
+        self.symbols = manifest['symbols']
+        self.data = manifest
+
+    # rewrites the days from the first one that changed, which is the first day
+    # the calendar gains or the first day a symbol's store changed since the
+    # panel last read it, and appends the days after the last one stored
+    def update(self, refresh=False):
+        self.symbols = get_cached_symbols() if self.params['symbols'] is None else self.params['symbols']
+        frames = get_symbol_frames(self.symbols, self.options_list, refresh, self.cached)
+        versions = get_store_versions(self.symbols)
+        columns = sorted(column for _, column in get_column_ids_list(self.options_list))
+        index = union_index([frame.index for frame in frames.values()])
+        manifest = read_manifest(self.get_path())
+        length = manifest['length'] if manifest and manifest['columns'] == columns else 0
+        start = self.get_unchanged_length(manifest, length, index, frames, versions, columns)
+        if length and start == length == len(index):
+            if manifest.get('versions') != versions:
+                manifest['versions'] = versions
+                write_manifest(self.get_path(), manifest)
+            return manifest
+        new_index = index[start:]
+        new_values = np.empty((len(new_index), len(self.symbols), len(columns)), dtype=VALUES_DTYPE)
+        for i, s in enumerate(self.symbols):
+            new_values[:, i] = get_symbol_values(frames.get(s), new_index, columns)
+        if start:
+            append_array(self.get_path(VALUES), new_values, VALUES_DTYPE, start * len(self.symbols) * len(columns))
+            append_array(self.get_path(INDEX), new_index, INDEX_DTYPE, start)
+        else:
+            make_path(self.get_path(VALUES))
+            write_array(self.get_path(VALUES), new_values, VALUES_DTYPE)
+            write_array(self.get_path(INDEX), new_index, INDEX_DTYPE)
+        manifest = {'symbols': self.symbols, 'columns': columns, 'length': len(index), 'versions': versions}
+        write_manifest(self.get_path(), manifest)
+        self.load(manifest)
+        return manifest
+
+    # the stored days up to the first that differs from the calendar or from a
+    # symbol whose store changed, or none when the panel would shrink since
+    # readers may still map the days past its end
+    def get_unchanged_length(self, manifest, length, index, frames, versions, columns):
+        if not length or len(index) < length or manifest['symbols'] != self.symbols:
+            return 0
+        stored_index = read_array(self.get_path(INDEX), INDEX_DTYPE, length)
+        moved = np.flatnonzero(index[:length] != stored_index)
+        start = int(moved[0]) if len(moved) else length
+        stored_versions = manifest.get('versions', {})
+        changed = [i for i, s in enumerate(self.symbols) if stored_versions.get(s) != versions[s]]
+        if changed and start:
+            shape = (length, len(self.symbols), len(columns))
+            values = np.memmap(self.get_path(VALUES), dtype=VALUES_DTYPE, mode='r', shape=shape)
+            for i in changed:
+                symbol_values = get_symbol_values(frames.get(self.symbols[i]), index[:start], columns)
+                start = get_first_change(values[:start, i], symbol_values)
+            del values
+        return start
+
+    def get_dates(self):
+        return [day_to_date(day) for day in self.index.tolist()]
+
+    # symbols x dates x features, a view of the stored array
+    def get_values(self):
+        return self.values.transpose(1, 0, 2)
+
+    def get_mask(self):
+        return ~np.isnan(self.get_values())
+
+    # inclusive, views of the dates between start and end
+    def slice(self, start, end):
+        lo = np.searchsorted(self.index, date_to_day(start), side='left')
+        hi = np.searchsorted(self.index, date_to_day(end), side='right')
+        return self.index[lo:hi], self.get_values()[:, lo:hi]
+
+    def get_frame(self, symbol):
+        i = self.symbols.index(symbol)
+        return SymbolFrame(self.index, {
+            column: self.values[:, i, j] for j, column in enumerate(self.data['columns'])
+        }).dropna()
+
+
+def get_symbol_frames(symbols, options_list, refresh, cached=False):
+    def get_frame(symbol):
+        if cached:
+            return get_cached_frame(symbol, options_list)
+        try:
+            return get_symbol_data(symbol, options_list, None, None, refresh).get_frame()
+        except DataException as e:
+            log_skip(symbol, e)
+    frames = map_concurrently(get_frame, symbols)
+    return {symbol: frame for symbol, frame in zip(symbols, frames) if frame is not None}
+
+
+# the rows of the options' columns the symbol's store has, without downloading
+# the ones it lacks
+def get_cached_frame(symbol, options_list):
+    index, columns = read_symbol_store(get_symbol_folder(symbol))
+    return get_symbol_frame(index, columns, options_list, None, None)
+
+
+# the symbol's values on the days of the index, NaN on days without a complete
+# row and on every day when it lacks a column
+def get_symbol_values(frame, index, columns):
+    values = np.full((len(index), len(columns)), np.nan, dtype=VALUES_DTYPE)
+    if frame is not None and all(column in frame.columns for column in columns):
+        positions, found = frame.locate(index)
+        values[found] = frame.get_matrix(columns)[positions[found]]
+    return values
+
+
+def get_first_change(stored, values):
+    changed = np.flatnonzero(~((stored == values) | (np.isnan(stored) & np.isnan(values))).all(axis=1))
+    return int(changed[0]) if len(changed) else len(stored)
+
+
+# the version of each symbol's store, which the panel keeps to tell which
+# symbols changed since it read them
+def get_store_versions(symbols):
+    versions = {}
+    for s in symbols:
+        version = get_store_version(get_symbol_folder(s))
+        versions[s] = list(version) if version else None
+    return versions
+
+
+def union_index(indexes):
+    if not indexes:
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    return np.unique(np.concatenate(indexes)).astype(INDEX_DTYPE)
+
+
+def add_args(parser):
+    symbol.add_symbol_args(parser)
+    parser.add_argument('-o', '--options', type=str, nargs='+', required=True,
+                        help='indices of data_options in params.py')
+    parser.add_argument('-r', '--refresh', action='store_true', help='refresh the data')
+
+
+def handle_args(args, parser):
+    symbol.handle_symbol_args(args, parser)
+    symbol.handle_options_args(args, parser)
+
+
+def main():
+    args = parse_args('Build a panel of symbol data.', add_args, handle_args)
+    panel = Panel(symbols=args.symbols, options_list=args.options_list)
+    panel.update(args.refresh)
+    log(panel.get_values().shape, force=args.print)
+    if args.path:
+        log(panel.get_path(), force=args.print)
+
+
+if __name__ == '__main__':
+    main()
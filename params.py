@@ -37,6 +37,54 @@ PARAMS = {
 
     'data_folder': os.environ.get('data_folder', DATA_FOLDER),
 
+    # processes used to preprocess symbols in parallel
+    'workers': int(os.environ.get('workers', os.cpu_count() or 1)),
+
+    'alphavantage_url': os.environ.get('alphavantage_url', 'https://www.alphavantage.co/query'),
+
+    # concurrent requests and the requests per minute budget shared between them
+    'download': {
+        'workers': int(os.environ.get('download_workers', 4)),
+        'requests_per_minute': float(os.environ.get('requests_per_minute', 5)),
+        'burst': 1,
+        # requests per day the job queue in jobs.py stops at
+        'daily_quota': int(os.environ.get('daily_quota', 500))
+    },
+
+    # HTTP timeout, and retries with exponential backoff in seconds on errors and throttling
+    'client': {
+        'timeout': float(os.environ.get('client_timeout', 30)),
+        'retries': int(os.environ.get('client_retries', 5)),
+        'backoff': float(os.environ.get('client_backoff', 15)),
+        'max_backoff': 120
+    },
+
+    # memory held by symbol data shared between readers in one process
+    'store_cache_bytes': int(os.environ.get('store_cache_bytes', 512 * 2 ** 20)),
+
+    # rows per training step of neural networks, which larger batches train
+    # faster with but converge differently at the same learning rate, and the
+    # epochs without a lower validation loss after which training stops, never when 0
+    'train': {
+        'batch_size': int(os.environ.get('train_batch_size', 32)),
+        'patience': int(os.environ.get('train_patience', 5))
+    },
+
+    # the prediction server in serve.py: its socket in the data folder, the trained
+    # networks it keeps loaded, and the rows and seconds it waits for to batch requests
+    'serve': {
+        'socket': os.environ.get('serve_socket', 'serve.sock'),
+        'models': int(os.environ.get('serve_models', 4)),
+        'batch_size': int(os.environ.get('serve_batch_size', 1024)),
+        'batch_wait': float(os.environ.get('serve_batch_wait', 0.005))
+    },
+
+    # calculate data_options indicators from cached daily data instead of downloading them
+    'local_indicators': os.environ.get('local_indicators', False),
+
+    # seconds Yahoo screener results are reused for
+    'screener_ttl': float(os.environ.get('screener_ttl', 3600)),
+
     'screeners': {
         'yahoo': [
             'undervalued_growth_stocks',
@@ -56,6 +104,21 @@ PARAMS = {
                     ['pricetoearnings', '>', 0]
                 ]
             }
+        },
+        # screened by screen.py over cached data
+        'local': {
+            'uptrend': {
+                'conditions': [
+                    ['close', '>', 'SMA'],
+                    ['RSI', '<', 70]
+                ]
+            },
+            'oversold': {
+                'conditions': [
+                    ['RSI', '<', 30],
+                    ['volume', '>', 0]
+                ]
+            }
         }
     },
 
@@ -1,12 +1,20 @@
 from argparse import Action
+from concurrent.futures import ProcessPoolExecutor
+from numpy.lib.stride_tricks import as_strided
 from data import Data, DataException
 from symbol import SymbolData, handle_options_args
+from frame import SymbolFrame
 import symbol
+import client
+import jobs
 from optimal import OptimalTrades
+from store import get_manifest_path, read_manifest, write_manifest, store_exists, read_store_tail
 from utility import *
 
 DATA_PARTS = ['training', 'validation', 'evaluation']
+LIVE_ROWS = 8
 NUM_PARTS = len(DATA_PARTS)
+SHARD_ROWS = 2 ** 16
 
 
 class NeuralNetworkData(Data):
@@ -18,6 +26,7 @@ class NeuralNetworkData(Data):
         self.options_list = params['options_list']
         self.days = params.get('days', 0)
         self.tolerance = params.get('tolerance', 0.01)
+        self.windowed = params.get('windowed', False)
         validate_parts([params[p] for p in DATA_PARTS])
         super().__init__(**params)
 
@@ -25,13 +34,15 @@ class NeuralNetworkData(Data):
         return 'preprocess'
 
     def get_part_path(self, part):
-        return self.get_path(part + '.pkl')
+        return self.get_path(part)
 
     def read_data(self):
-        return read_preprocess(self.get_path())
+        return read_preprocess(self.get_path(), self.get_legacy_inputs())
 
+    # the parts are read back memory mapped so the new matrices can be freed
     def write_data(self):
-        write_preprocess(self.get_path(), self.get_data())
+        write_preprocess(self.get_path(), self.get_data(), self.get_new_inputs())
+        self.data = read_preprocess(self.get_path())
 
     def get_new_data(self):
         log('Preprocessing neural network data...')
@@ -39,90 +50,359 @@ class NeuralNetworkData(Data):
 
     def get_new_data_part(self, part):
         return get_data_part(part['symbols'], self.options_list, part['start'],
-                             part['end'], self.days, self.tolerance)
+                             part['end'], self.days, self.tolerance, self.windowed)
 
     def get_shape(self):
-        return self.get_data()[DATA_PARTS[0]][0].shape[1]
+        return read_manifest(self.get_part_path(DATA_PARTS[0]))['shape']
 
+    # the (column, prior) of each input in the order the parts have them
+    def get_inputs(self):
+        return read_manifest(self.get_part_path(DATA_PARTS[0]))['inputs']
 
-def read_preprocess_part(path):
-    data = read_pickle(path)
+    def get_new_inputs(self):
+        return get_input_order(get_input_columns(self.options_list), self.days)
+
+    # the order of parts pickled before the order was kept
+    def get_legacy_inputs(self):
+        columns = get_input_columns(self.options_list)
+        return get_legacy_input_order(columns, self.days, get_legacy_names(columns))
+
+
+# the rows of every symbol and the positions of the rows to train on, from which
+# each position's prior days are only gathered when a batch is asked for
+class WindowedPart:
+
+    def __init__(self, values, positions, out, days, columns, inputs=None):
+        self.values = values
+        self.positions = positions
+        self.out = out
+        self.days = days
+        self.columns = columns
+        self.inputs = get_input_order(columns, days) if inputs is None else inputs
+
+    def __len__(self):
+        return len(self.positions)
+
+    def get_shape(self):
+        return len(self.columns) * (self.days + 1)
+
+    def get_batch(self, indices):
+        return lag_matrix(self.values, self.positions[indices], self.days, self.columns, self.inputs), \
+            self.out[indices]
+
+    def iterate_batches(self, batch_size, shuffle=False):
+        order = np.random.permutation(len(self)) if shuffle else np.arange(len(self))
+        for i in range(0, len(self), batch_size):
+            yield self.get_batch(order[i:i + batch_size])
+
+    def materialize(self):
+        return self.get_batch(np.arange(len(self)))
+
+
+# a part written as shards of at most SHARD_ROWS rows, each memory mapped
+class ShardedPart:
+
+    def __init__(self, folder, manifest):
+        self.shape = manifest['shape']
+        self.inputs = manifest['inputs']
+        self.shards = [(read_shard(folder, shard['in']), read_shard(folder, shard['out']))
+                       for shard in manifest['shards']]
+
+    def __len__(self):
+        return sum(len(matrix_out) for _, matrix_out in self.shards)
+
+    def get_shape(self):
+        return self.shape
+
+    # shuffles the order of the shards and the rows within each one, so that
+    # only one shard is paged in at a time
+    def iterate_batches(self, batch_size, shuffle=False):
+        order = np.random.permutation(len(self.shards)) if shuffle else range(len(self.shards))
+        for i in order:
+            matrix_in, matrix_out = self.shards[i]
+            rows = np.random.permutation(len(matrix_out)) if shuffle else np.arange(len(matrix_out))
+            for j in range(0, len(rows), batch_size):
+                yield matrix_in[rows[j:j + batch_size]], matrix_out[rows[j:j + batch_size]]
+
+    def materialize(self):
+        return (np.concatenate([matrix_in for matrix_in, _ in self.shards]),
+                np.concatenate([matrix_out for _, matrix_out in self.shards]))
+
+
+def read_shard(folder, file_name):
+    return np.load(os.path.join(folder, file_name), mmap_mode='r')
+
+
+def write_shard(folder, file_name, array):
+    path = os.path.join(folder, file_name)
+    with open(path + '.tmp', 'wb') as fh:
+        np.save(fh, np.ascontiguousarray(array))
+    os.replace(path + '.tmp', path)
+    return file_name
+
+
+# pickled parts are migrated with the legacy inputs order they were built in,
+# and parts written before the order was kept are built again
+def read_preprocess_part(folder, part, legacy_inputs=None):
+    path = os.path.join(folder, part)
+    if not store_exists(path) and os.path.exists(path + '.pkl') and legacy_inputs is not None:
+        migrate_preprocess_part(folder, part, legacy_inputs)
+    remove_kur_copy(path)
+    manifest = read_manifest(path)
+    if not manifest or 'inputs' not in manifest:
+        return
+    if manifest.get('windowed'):
+        return WindowedPart(read_shard(path, 'values.npy'), read_shard(path, 'positions.npy'),
+                            read_shard(path, 'out.npy'), manifest['days'], manifest['columns'], manifest['inputs'])
+    return ShardedPart(path, manifest)
+
+
+# kur was trained on a copy of each part materialized in full, which the parts
+# are read from in batches instead of now
+def remove_kur_copy(path):
+    if os.path.exists(path + '.kur.pkl'):
+        os.remove(path + '.kur.pkl')
+
+
+def migrate_preprocess_part(folder, part, inputs):
+    data = read_pickle(os.path.join(folder, part + '.pkl'))
     if data:
-        return data['in'], data['out']
+        log('Migrating %s data to shards...' % part)
+        write_data_part(folder, {part: (data['in'], data['out'])}, part, inputs)
 
 
-def read_preprocess(folder):
-    data = {k: read_preprocess_part(os.path.join(folder, k + '.pkl')) for k in DATA_PARTS}
+def read_preprocess(folder, legacy_inputs=None):
+    data = {k: read_preprocess_part(folder, k, legacy_inputs) for k in DATA_PARTS}
     if None not in data.values():
         return data
 
 
-def write_data_part(folder, data, part):
-    path = os.path.join(folder, part + '.pkl')
-    make_path(path)
+# the manifest is written last, so a part is only read once all of it is written,
+# with the order of the inputs, which windowed parts have their own of
+def write_data_part(folder, data, part, inputs):
+    path = os.path.join(folder, part)
+    make_path(get_manifest_path(path))
+    if type(data[part]) is WindowedPart:
+        windowed = data[part]
+        write_shard(path, 'values.npy', windowed.values)
+        write_shard(path, 'positions.npy', windowed.positions)
+        write_shard(path, 'out.npy', windowed.out)
+        return write_manifest(path, {'windowed': True, 'days': windowed.days, 'columns': windowed.columns,
+                                     'inputs': windowed.inputs, 'shape': windowed.get_shape(),
+                                     'rows': len(windowed)})
     matrix_in, matrix_out = data[part]
-    write_pickle(path, {'in': matrix_in, 'out': matrix_out})
+    shards = [{
+        'in': write_shard(path, 'in.%s.npy' % i, matrix_in[row:row + SHARD_ROWS]),
+        'out': write_shard(path, 'out.%s.npy' % i, matrix_out[row:row + SHARD_ROWS])
+    } for i, row in enumerate(range(0, len(matrix_out), SHARD_ROWS))]
+    write_manifest(path, {'shards': shards, 'inputs': inputs, 'shape': matrix_in.shape[1], 'rows': len(matrix_out)})
 
 
-def write_preprocess(folder, data):
-    [write_data_part(folder, data, p) for p in DATA_PARTS]
+def write_preprocess(folder, data, inputs):
+    [write_data_part(folder, data, p, inputs) for p in DATA_PARTS]
 
 
 def get_symbol_part(symbol, options_list, start, end, days, tolerance):
-    symbol_data = SymbolData(symbol=symbol, options_list=options_list).get_data()
+    values, positions, out, columns = get_symbol_base(symbol, options_list, start, end, days, tolerance)
+    return lag_matrix(values, positions, days, columns), out
+
+
+# the symbol's rows from days before its first matched date, the positions of
+# the matched dates within them and the labels of those dates
+def get_symbol_base(symbol, options_list, start, end, days, tolerance):
+    frame = SymbolData(symbol=symbol, options_list=options_list).get_frame()
     trades = OptimalTrades(symbol=symbol, start=start, end=end, tolerance=tolerance).get_data()
-    data_in, data_out = filter_matching(symbol_data, trades)
-    data_in = add_prior_days(data_in, days, symbol_data)
     try:
-        new_in = json_to_matrix(data_in)
-        new_out = json_to_matrix(data_out)
-    except:
-        print(symbol, options_list)  # TODO fix
-        raise Exception
-    if 0 in new_in.shape:
-        print(symbol, options_list)  # TODO fix
-        # try again
+        labels = SymbolFrame.from_series(trades, 'label')
+    except (TypeError, ValueError):
+        raise DataException('Failed to convert %s data to matrices' % symbol)
+    values, positions, out, columns = align_part(frame, labels, days)
+    if not len(positions) or not len(columns):
+        raise DataException('No %s data between %s and %s' % (symbol, start, end))
+    return values, positions, out, columns
+
+
+# joins the complete feature rows and the labels on their days in one step,
+# keeping the labelled days with days rows of history before them
+def align_part(frame, labels, days):
+    frame = frame.dropna()
+    # columns are sorted so that every symbol's rows line up
+    columns = sorted(frame.get_columns())
+    positions, found = frame.locate(labels.index)
+    out = labels.get_series('label')
+    keep = found & ~np.isnan(out) & (positions >= days)
+    positions = positions[keep]
+    if not len(positions):
+        return np.zeros((0, len(columns))), positions, out[keep], columns
+    first = positions[0] - days
+    values = frame.take(slice(first, positions[-1] + 1)).get_matrix(columns)
+    return values, positions - first, out[keep], columns
+
+
+# the input rows of the dates built as align_part and lag_matrix build the parts',
+# with the inputs in the order given, and which dates have one, a complete row
+# with days rows of history before it
+def get_symbol_inputs(frame, dates, days, inputs=None):
+    frame = frame.dropna()
+    columns = sorted(frame.get_columns())
+    inputs = get_input_order(columns, days) if inputs is None else inputs
+    if set(columns) != {column for column, _ in inputs}:
+        raise DataException('Expected %s columns but got %s' % (len({column for column, _ in inputs}), len(columns)))
+    positions, found = frame.locate(dates_to_days(dates))
+    found &= positions >= days
+    positions = positions[found]
+    if not len(positions) or not len(columns):
+        return np.zeros((len(positions), len(inputs))), found
+    first = positions.min() - days
+    values = frame.take(slice(first, positions.max() + 1)).get_matrix(columns)
+    return lag_matrix(values, positions - first, days, columns, inputs), found
+
+
+# the symbols with data, the latest complete day of each, and a matrix of the
+# input row of each of those days, built from only the trailing rows of the
+# cached data with the inputs in the order given
+def get_live_inputs(symbols, options_list, days, inputs=None):
+    column_ids = [column_id for _, column_id in get_column_ids_list(options_list)]
+    columns = sorted(column_ids)
+    inputs = get_input_order(columns, days) if inputs is None else inputs
+    priors, column_indices = lag_column_order(columns, inputs)
+    kept, dates, rows = [], [], []
+    for s in symbols:
+        frame = get_live_frame(s, set(column_ids), days)
+        if len(frame) > days and len(frame.get_columns()) == len(columns):
+            values = frame.get_matrix(columns)
+            kept.append(s)
+            dates.append(day_to_date(frame.index[-1]))
+            rows.append(values[len(values) - 1 - priors, column_indices])
+    return kept, dates, np.array(rows).reshape(len(rows), len(inputs))
+
+
+# the symbol's last complete rows, at least days + 1 of them when it has those,
+# reading more of the store only when rows missing a value leave too few
+def get_live_frame(s, column_ids, days):
+    folder = symbol.get_symbol_folder(s)
+    symbol.migrate_column_names(folder)
+    rows = days + 1 + LIVE_ROWS
+    while True:
+        index, columns = read_store_tail(folder, rows, column_ids)
+        frame = SymbolFrame(index, columns).dropna()
+        if len(frame) > days or len(index) < rows:
+            return frame
+        rows *= 4
+
+
+# runs in a worker process with the parent's PARAMS, which share its download
+# budget, and returns the error message of data that could not be had instead
+# of raising, while any other error is a bug and raises
+def get_symbol_part_worker(args):
+    params, symbol, options_list, start, end, days, tolerance, windowed = args
+    PARAMS.update(params)
+    try:
+        if windowed:
+            return get_symbol_base(symbol, options_list, start, end, days, tolerance)
         return get_symbol_part(symbol, options_list, start, end, days, tolerance)
-    return new_in, new_out
-
-
-def get_data_part(symbols, options_list, start, end, days, tolerance):
-    matrix_in = None
-    matrix_out = None
-    for symbol in symbols:
-        try:
-            new_in, new_out = get_symbol_part(symbol, options_list, start, end, days, tolerance)
-        except DataException:
-            continue
-        if matrix_in is None:
-            matrix_in = new_in
-            matrix_out = new_out
+    except (DataException,) + client.REQUEST_ERRORS as e:
+        return str(e)
+
+
+def get_symbol_parts(symbols, options_list, start, end, days, tolerance, windowed=False):
+    workers = min(PARAMS['workers'], len(symbols))
+    params = {**PARAMS, 'download': {**PARAMS['download']}}
+    params['download']['requests_per_minute'] /= max(workers, 1)
+    tasks = [(params, symbol, options_list, start, end, days, tolerance, windowed) for symbol in symbols]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(get_symbol_part_worker, tasks))
+    else:
+        results = [get_symbol_part_worker((PARAMS,) + task[1:]) for task in tasks]
+    parts = {}
+    failures = {}
+    for symbol, result in zip(symbols, results):
+        if type(result) is str:
+            failures[symbol] = result
         else:
-            if len(new_in.shape) != 2:
-                print(matrix_in.shape, new_in.shape, symbol)  # TODO fix
-                print(matrix_out.shape, new_out.shape)
-                raise Exception
-            matrix_in = np.concatenate((matrix_in, new_in))
-            matrix_out = np.concatenate((matrix_out, new_out))
+            parts[symbol] = result
+    return parts, failures
+
+
+def get_data_part(symbols, options_list, start, end, days, tolerance, windowed=False):
+    parts, failures = get_symbol_parts(symbols, options_list, start, end, days, tolerance, windowed)
+    if parts:
+        columns = next(iter(parts.values()))[0].shape[1]
+        for symbol, part in list(parts.items()):
+            if part[0].shape[1] != columns:
+                failures[symbol] = 'Expected %s columns of %s data but got %s' % (columns, symbol, part[0].shape[1])
+                del parts[symbol]
+    for symbol, error in failures.items():
+        log_skip(symbol, error)
+    if not parts:
+        raise DataException('Failed to preprocess any of ' + ', '.join(symbols))
+    if windowed:
+        return get_windowed_part(parts, days)
+    # fill arrays sized for every symbol at once instead of growing them
+    rows = sum(len(new_in) for new_in, _ in parts.values())
+    matrix_in = np.empty((rows, columns))
+    matrix_out = np.empty(rows)
+    row = 0
+    for new_in, new_out in parts.values():
+        matrix_in[row:row + len(new_in)] = new_in
+        matrix_out[row:row + len(new_out)] = new_out
+        row += len(new_in)
     return matrix_in, matrix_out
 
 
-def add_prior_days(data, days, full_data):
-    if not data:
-        return data
-    new_data = {}
-    date_list = list(enumerate(sorted(data)))
-    full_data_sorted = sorted(full_data)
-    full_date_list = list(enumerate(full_data_sorted))
-    start_date = full_data_sorted.index(date_list[0][1])
-    end_date = full_data_sorted.index(date_list[-1][1])
-    for current, date in full_date_list[start_date:end_date + 1]:
-        new_data[date] = {}
-        for prior in range(days + 1):
-            prior_data = full_data[full_date_list[current - prior][1]]
-            for col in list(prior_data):
-                new_data[date][str(col) + str(prior)] = prior_data[col]
-    return new_data
+def get_windowed_part(parts, days):
+    columns = next(iter(parts.values()))[3]
+    offsets = np.cumsum([0] + [len(values) for values, _, _, _ in parts.values()])
+    return WindowedPart(
+        np.concatenate([values for values, _, _, _ in parts.values()]),
+        np.concatenate([positions + offset for (_, positions, _, _), offset in zip(parts.values(), offsets)]),
+        np.concatenate([out for _, _, out, _ in parts.values()]),
+        days, columns
+    )
+
+
+# matrix of each position's row and the days rows before it, with the
+# (column, prior) inputs in the order given, sorted on the pairs by default
+def lag_matrix(values, positions, days, columns, inputs=None):
+    rows, width = values.shape
+    values = np.ascontiguousarray(values)
+    windows = as_strided(values, shape=(max(rows - days, 0), days + 1, width),
+                         strides=(values.strides[0], values.strides[0], values.strides[1]),
+                         writeable=False)
+    inputs = get_input_order(columns, days) if inputs is None else inputs
+    priors, column_indices = lag_column_order(columns, inputs)
+    return windows[(np.asarray(positions, dtype=np.intp) - days)[:, None], days - priors, column_indices]
+
+
+# the prior and the position in columns of every input
+def lag_column_order(columns, inputs):
+    positions = {column: i for i, column in enumerate(columns)}
+    return np.array([prior for _, prior in inputs], dtype=np.intp), \
+        np.array([positions[column] for column, _ in inputs], dtype=np.intp)
+
+
+# the columns of the options every symbol's rows line up on
+def get_input_columns(options_list):
+    return sorted(column_id for _, column_id in get_column_ids_list(options_list))
+
+
+def get_input_order(columns, days):
+    return sorted((column, prior) for column in columns for prior in range(days + 1))
+
+
+# the order inputs were built in before the schema's column ids, the sorted
+# str(name) + str(prior) keys of the names the columns had then
+def get_legacy_input_order(columns, days, names):
+    keys = sorted((str(name) + str(prior), column, prior)
+                  for column, name in zip(columns, names) for prior in range(days + 1))
+    return [(column, prior) for _, column, prior in keys]
+
+
+# the encrypted options the columns were named by before the schema
+def get_legacy_names(columns):
+    schema = get_schema()
+    return [encrypt_dict(schema.get_options(column)) for column in columns]
 
 
 def validate_parts(parts):
@@ -236,6 +516,10 @@ def add_args(parser):
                         help='tolerance to use in optimal trades algorithm')
     parser.add_argument('-d', '--days', type=int, default=0,
                         help='number of prior days of data to use as input per day')
+    parser.add_argument('--windowed', action='store_true',
+                        help='store each day once and gather prior days per batch')
+    parser.add_argument('--queue', action='store_true',
+                        help='download missing data through the job queue, ahead of other queued downloads')
 
 
 def handle_symbols(args, parser):
@@ -280,6 +564,32 @@ def handle_parts(args, parser):
             parser.error('Either 0, 1, or %s --start and --end is required' % NUM_PARTS)
 
 
+# only passed when set so that existing data keeps its path
+def get_windowed_params(args):
+    return {'windowed': True} if args.windowed else {}
+
+
+# downloads the data the parts need through the job queue before anything else
+# queued, and returns whether all of it fit in today's quota
+def download_queued(parts, options_list):
+    symbols = get_parts_symbols(parts)
+    jobs.add_jobs(symbols, options_list, priority=jobs.NEEDED)
+    jobs.run_jobs(symbols)
+    left = jobs.get_jobs(symbols)
+    if left:
+        log('%s downloads are left for when the quota allows' % len(left), force=True)
+    return not left
+
+
+def get_parts_symbols(parts):
+    return list(dict.fromkeys(s for p in DATA_PARTS for s in parts[p]['symbols']))
+
+
+# the calls the parts' missing data needs, which preprocessing would make
+def get_parts_cost(parts, options_list):
+    return symbol.get_portfolio_plan(get_parts_symbols(parts), options_list, None, None, False).get_cost()
+
+
 def handle_args(args, parser):
     handle_dates(args, parser)
     handle_symbols(args, parser)
@@ -290,8 +600,12 @@ def handle_args(args, parser):
 
 def main():
     args = parse_args('Preprocess neural network data.', add_args, handle_args)
+    if args.dry_run:
+        return log(get_parts_cost(args.parts, args.options_list), force=True)
+    if args.queue and not download_queued(args.parts, args.options_list):
+        return
     data = NeuralNetworkData(**args.parts, options_list=args.options_list, days=args.days,
-                             tolerance=args.tolerance)
+                             tolerance=args.tolerance, **get_windowed_params(args))
     log(data.get_data(), force=args.print)
     if args.path:
         log(data.get_path(), force=args.print)
@@ -0,0 +1,80 @@
+import fcntl
+import json
+import os
+import threading
+from params import PARAMS
+
+SCHEMA_FILE = 'schema.jsonl'
+SCHEMAS = {}
+LOCK = threading.Lock()
+
+
+def get_column_key(options):
+    return json.dumps(options, sort_keys=True, separators=(',', ':'))
+
+
+# gives every { **options, 'column': column } a small integer id, the line it is
+# on in an append only file shared by every process using the data folder
+class Schema:
+
+    def __init__(self, path):
+        self.path = path
+        self.ids = {}
+        self.keys = []
+        self.lock = threading.Lock()
+        with self.lock:
+            self.locked(fcntl.LOCK_SH, self.load)
+
+    def locked(self, operation, fn):
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, operation)
+            try:
+                return fn()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    # reads the lines other processes appended since the last load
+    def load(self):
+        try:
+            with open(self.path, 'r') as fh:
+                lines = fh.read().splitlines()
+        except FileNotFoundError:
+            return
+        for key in lines[len(self.keys):]:
+            self.ids[key] = len(self.keys)
+            self.keys.append(key)
+
+    def get_id(self, options, column):
+        return self.get_key_id({**options, 'column': column})
+
+    def get_key_id(self, options):
+        key = get_column_key(options)
+        if key not in self.ids:
+            with self.lock:
+                self.locked(fcntl.LOCK_EX, lambda: self.add(key))
+        return self.ids[key]
+
+    def add(self, key):
+        self.load()
+        if key not in self.ids:
+            with open(self.path, 'a') as fh:
+                fh.write(key + '\n')
+            self.ids[key] = len(self.keys)
+            self.keys.append(key)
+
+    # the options the column was downloaded with, including its column name
+    def get_options(self, column_id):
+        if column_id >= len(self.keys):
+            with self.lock:
+                self.locked(fcntl.LOCK_SH, self.load)
+        return json.loads(self.keys[column_id])
+
+
+def get_schema():
+    path = os.path.join(os.getcwd(), PARAMS['data_folder'], SCHEMA_FILE)
+    with LOCK:
+        if path not in SCHEMAS:
+            SCHEMAS[path] = Schema(path)
+        return SCHEMAS[path]
@@ -0,0 +1,123 @@
+from panel import Panel
+from symbol import get_cached_symbols, get_portfolio_plan
+from utility import *
+
+OPERATORS = {
+    '>': np.greater,
+    '>=': np.greater_equal,
+    '<': np.less,
+    '<=': np.less_equal,
+    '=': np.equal,
+    '!=': np.not_equal
+}
+LOOKBACK = 5
+
+
+# screens cached symbol data with conditions shaped like the intrinio ones,
+# [field, operator, value], where fields are data_options columns such as
+# close or RSI, or option:column such as sma(50):SMA, and values are numbers or
+# other fields, compared on each symbol's latest row in the last lookback days;
+# only stored columns are screened, a symbol without one failing conditions on
+# it, unless refresh downloads them first
+def screen(conditions, symbols=None, date=None, lookback=LOOKBACK, update=False, refresh=False):
+    fields = {field: get_field(field) for field in get_condition_fields(conditions)}
+    options_list = remove_duplicates([options for options, _ in fields.values()])
+    if refresh:
+        get_portfolio_plan(symbols or get_cached_symbols(), options_list, None, None, True).execute()
+    panel = Panel(symbols=symbols, options_list=options_list, cached=True)
+    if update or refresh:
+        panel.update()
+    values = get_latest_values(panel.index, panel.values, date, lookback)
+    positions = {column: i for i, column in enumerate(panel.data['columns'])}
+    schema = get_schema()
+    columns = {field: positions[schema.get_id(options, column)] for field, (options, column) in fields.items()}
+    keep = apply_conditions(conditions, lambda field: values[:, columns[field]], len(panel.symbols))
+    return [symbol for symbol, kept in zip(panel.symbols, keep.tolist()) if kept]
+
+
+def screen_named(name, **kwargs):
+    return screen(PARAMS['screeners']['local'][name]['conditions'], **kwargs)
+
+
+def get_condition_fields(conditions):
+    fields = []
+    for field, _, value in conditions:
+        fields += [field] + ([value] if type(value) is str else [])
+    return remove_duplicates(fields)
+
+
+def get_field(field):
+    if ':' in field:
+        options_str, column = field.rsplit(':', 1)
+        options = get_options(options_str)
+    else:
+        column = field
+        options = next((factory() for factory in PARAMS['data_options'].values()
+                        if field in factory()['columns']), None)
+    if options is None or column not in options['columns']:
+        raise Exception('Unknown screener field: %s' % field)
+    return options, column
+
+
+# symbols x features of each symbol's last row with data up to date, NaN when
+# it has none in the lookback days before
+def get_latest_values(index, values, date, lookback):
+    hi = len(index) if date is None else int(np.searchsorted(index, date_to_day(date), side='right'))
+    window = np.asarray(values[max(hi - lookback, 0):hi])
+    symbols = values.shape[1]
+    if not len(window):
+        return np.full((symbols, values.shape[2]), np.nan)
+    valid = ~np.isnan(window).all(axis=2)
+    last = len(window) - 1 - np.argmax(valid[::-1], axis=0)
+    latest = window[last, np.arange(symbols)].astype(np.float64)
+    latest[~valid.any(axis=0)] = np.nan
+    return latest
+
+
+# NaN fails every condition
+def apply_conditions(conditions, get_values, count):
+    keep = np.ones(count, dtype=bool)
+    with np.errstate(invalid='ignore'):
+        for field, operator, value in conditions:
+            if operator not in OPERATORS:
+                raise Exception('Unknown screener operator: %s' % operator)
+            other = get_values(value) if type(value) is str else float(value)
+            keep &= OPERATORS[operator](get_values(field), other)
+    return keep
+
+
+def add_args(parser):
+    parser.add_argument('screener', type=str, nargs='?', help='name of a local screener in params.py')
+    parser.add_argument('-c', '--condition', type=str, nargs=3, action='append', default=[],
+                        metavar=('FIELD', 'OPERATOR', 'VALUE'), help='condition to screen with')
+    parser.add_argument('-s', '--symbols', type=str, nargs='+', help='symbol(s), all cached ones by default')
+    parser.add_argument('-d', '--date', type=str, help='date to screen on, the latest by default')
+    parser.add_argument('-u', '--update', action='store_true', help='add newly cached symbols and days first')
+    parser.add_argument('-r', '--refresh', action='store_true', help='refresh the data first')
+
+
+def handle_args(args, parser):
+    if not args.screener and not args.condition:
+        parser.error('A screener or at least one -c/--condition is required')
+    if args.screener and args.screener not in PARAMS['screeners']['local']:
+        parser.error('Unknown local screener: %s' % args.screener)
+    conditions = PARAMS['screeners']['local'][args.screener]['conditions'] if args.screener else []
+    args.conditions = conditions + [[field, operator, parse_value(value)]
+                                    for field, operator, value in args.condition]
+
+
+def parse_value(value):
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def main():
+    args = parse_args('Screen cached symbol data.', add_args, handle_args)
+    symbols = screen(args.conditions, args.symbols, args.date, update=args.update, refresh=args.refresh)
+    log(' '.join(symbols), force=args.print)
+
+
+if __name__ == '__main__':
+    main()
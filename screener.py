@@ -2,7 +2,11 @@ from __future__ import (absolute_import, division, print_function, unicode_liter
 
 from argparse import ArgumentParser
 from urllib.parse import quote_plus
-import requests
+from datetime import date as Date
+import json
+import os
+import time
+import client
 from base64 import b64encode
 from pyquery import PyQuery as pq
 from utility import *
@@ -10,11 +14,58 @@ from utility import *
 
 # get data from Yahoo predefined screeners
 def yahoo(screener):
-    d = pq(url='https://finance.yahoo.com/screener/predefined/%s' % screener)
+    d = pq(client.get('yahoo', 'https://finance.yahoo.com/screener/predefined/%s' % screener).text)
     elements = d("td.Va\\(m\\) > a.Fw\\(b\\)")
     return [a.text for a in elements]
 
 
+# Yahoo results are kept as dated snapshots in data_folder/screener/<name> and
+# reused for screener_ttl seconds, and name@YYYY-MM-DD reads that day's snapshot
+def get_screener_symbols(screener):
+    name, _, date = screener.partition('@')
+    folder = get_screener_folder(name)
+    if date:
+        symbols = read_snapshot(os.path.join(folder, date + '.json'))
+        if symbols is None:
+            raise Exception('No %s screener snapshot for %s' % (name, date))
+        return symbols
+    latest = get_latest_snapshot(folder)
+    if latest and time.time() - os.path.getmtime(latest) < PARAMS['screener_ttl']:
+        return read_snapshot(latest)
+    symbols = yahoo(name)
+    # an empty page is more likely a failed scrape than an empty screener
+    if symbols:
+        write_snapshot(os.path.join(folder, Date.today().isoformat() + '.json'), symbols)
+    return symbols
+
+
+def get_screener_folder(name):
+    return os.path.join(os.getcwd(), PARAMS['data_folder'], 'screener', name)
+
+
+def get_latest_snapshot(folder):
+    try:
+        snapshots = sorted(f for f in os.listdir(folder) if f.endswith('.json'))
+    except FileNotFoundError:
+        return
+    return os.path.join(folder, snapshots[-1]) if snapshots else None
+
+
+def read_snapshot(path):
+    try:
+        with open(path, 'r') as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return
+
+
+def write_snapshot(path, symbols):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as fh:
+        json.dump(symbols, fh)
+    os.replace(path + '.tmp', path)
+
+
 # AAII screener 'table > tbody > tr:nth-child(2n+1) > td:nth-child(2) > a'
 # needs authentication
 
@@ -31,7 +82,7 @@ def request(conditions):
     headers = {
         'Authorization': auth
     }
-    return requests.get(url, headers=headers).json()
+    return client.get_json('intrinio', url, headers=headers)
 
 
 def encode_element(element):
@@ -58,7 +109,7 @@ def encode_conditions(conditions):
 
 
 def add_args(parser):
-    parser.add_argument('screener', type=str, help='name of Yahoo screener')
+    parser.add_argument('screener', type=str, help='name of Yahoo screener, or name@YYYY-MM-DD for a saved snapshot')
     parser.add_argument('-l', '--limit', type=int, help='take the first l symbols')
 
 
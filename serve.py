@@ -0,0 +1,228 @@
+import queue
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from socketserver import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+from neural import NeuralNetwork
+from utility import *
+
+
+# a trained network's predict_batch, loaded and compiled once
+def load_network(path):
+    network = NeuralNetwork.load(path)
+    network.load_model()
+    return network.predict_batch
+
+
+class ClosedException(Exception):
+    pass
+
+
+# scores the rows of requests that arrive within wait seconds of each other in
+# one predict call of up to batch_size rows, on a thread of its own so that the
+# model is only ever used by one thread
+class Batcher:
+
+    def __init__(self, predict, batch_size, wait):
+        self.predict = predict
+        self.batch_size = batch_size
+        self.wait = wait
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    # raises ClosedException once closed, since nothing would score the rows
+    def submit(self, rows):
+        rows = np.asarray(rows, dtype=np.float64)
+        if rows.ndim != 2:
+            raise Exception('Rows must be a list of lists of numbers')
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise ClosedException('The batcher was closed')
+            self.requests.put((rows, future))
+        return future
+
+    # requests submitted before close are still scored
+    def close(self):
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.requests.put(None)
+
+    # a request with rows of another width than the batch's starts the next one
+    def run(self):
+        pending = None
+        while True:
+            request = pending or self.requests.get()
+            if request is None:
+                return
+            batch, pending, closed = [request], None, False
+            count = len(request[0])
+            deadline = time.monotonic() + self.wait
+            while count < self.batch_size:
+                try:
+                    request = self.requests.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    closed = True
+                    break
+                if request[0].shape[1] != batch[0][0].shape[1]:
+                    pending = request
+                    break
+                batch.append(request)
+                count += len(request[0])
+            self.score(batch)
+            if closed:
+                return
+
+    def score(self, batch):
+        self.batches += 1
+        try:
+            predictions = np.asarray(self.predict(np.concatenate([rows for rows, _ in batch])))
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        start = 0
+        for rows, future in batch:
+            future.set_result(predictions[start:start + len(rows)].tolist())
+            start += len(rows)
+
+
+# batchers of the networks asked for, the least recently used one closed past
+# size of them; each network is loaded outside the lock, so that requests for
+# the others go on, and once however many requests ask for it at the same time
+class ModelCache:
+
+    def __init__(self, size, load=load_network):
+        self.size = size
+        self.load = load
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        with self.lock:
+            future = self.entries.get(path)
+            loading = future is None
+            if loading:
+                future = self.entries[path] = Future()
+                while len(self.entries) > self.size:
+                    _, evicted = self.entries.popitem(last=False)
+                    evicted.add_done_callback(close_batcher)
+            else:
+                self.entries.move_to_end(path)
+        if loading:
+            self.load_batcher(path, future)
+        return future.result()
+
+    # a network that failed to load is loaded again by the next request for it
+    def load_batcher(self, path, future):
+        log('Loading %s...' % path)
+        try:
+            predict = self.load(path)
+        except Exception as e:
+            with self.lock:
+                if self.entries.get(path) is future:
+                    del self.entries[path]
+            future.set_exception(e)
+            return
+        future.set_result(Batcher(predict, PARAMS['serve']['batch_size'], PARAMS['serve']['batch_wait']))
+
+    # the rows' predictions, from the batcher of the network loaded again when
+    # it is evicted before the rows are submitted
+    def submit(self, path, rows):
+        while True:
+            try:
+                return self.get(path).submit(rows)
+            except ClosedException:
+                pass
+
+    def clear(self):
+        with self.lock:
+            for future in self.entries.values():
+                future.add_done_callback(close_batcher)
+            self.entries.clear()
+
+
+def close_batcher(future):
+    if not future.exception():
+        future.result().close()
+
+
+# a line of JSON per request, { model: network path, rows: [[...]] }, answered
+# with a line of { predictions: [...] } or { error: message }
+class PredictHandler(StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                rows = self.server.models.submit(request['model'], request['rows']).result()
+                response = {'predictions': rows}
+            except Exception as e:
+                response = {'error': '%s: %s' % (type(e).__name__, e)}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+class PredictServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, models):
+        self.models = models
+        if os.path.exists(path):
+            os.remove(path)
+        make_path(path)
+        super().__init__(path, PredictHandler)
+
+    def server_close(self):
+        super().server_close()
+        self.models.clear()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def get_socket_path():
+    return os.path.join(os.getcwd(), PARAMS['data_folder'], PARAMS['serve']['socket'])
+
+
+# the predictions of the network in folder path for the rows, from the server
+def predict(path, rows, socket_path=None):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path or get_socket_path())
+        request = {'model': path, 'rows': np.asarray(rows, dtype=np.float64).tolist()}
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with sock.makefile('rb') as fh:
+            response = json.loads(fh.readline().decode('utf-8'))
+    if 'error' in response:
+        raise Exception(response['error'])
+    return response['predictions']
+
+
+def add_args(parser):
+    parser.add_argument('--socket', type=str, help='path of the socket, serve.sock in the data folder by default')
+
+
+def handle_args(args, parser):
+    args.socket = args.socket or get_socket_path()
+
+
+def main():
+    args = parse_args('Serve neural network predictions.', add_args, handle_args)
+    server = PredictServer(args.socket, ModelCache(PARAMS['serve']['models']))
+    log('Serving on %s' % args.socket, force=args.print)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
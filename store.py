@@ -0,0 +1,301 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from utility import *
+
+MANIFEST = 'manifest.json'
+INDEX = 'index.i4'
+INDEX_DTYPE = np.int32
+COLUMN_DTYPE = np.float64
+CACHE = None
+CACHE_LOCK = threading.Lock()
+
+
+# a store is a folder with one int32 day-number index file, one float64 file
+# per column and a manifest listing the columns and the number of valid rows
+def get_manifest_path(folder):
+    return os.path.join(folder, MANIFEST)
+
+
+def read_manifest(folder):
+    try:
+        with open(get_manifest_path(folder), 'r') as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return
+
+
+def write_manifest(folder, manifest):
+    path = get_manifest_path(folder)
+    make_path(path)
+    with open(path + '.tmp', 'w') as fh:
+        json.dump(manifest, fh)
+    os.replace(path + '.tmp', path)
+
+
+def store_exists(folder):
+    return read_manifest(folder) is not None
+
+
+def empty_store():
+    return np.zeros(0, dtype=INDEX_DTYPE), {}
+
+
+def read_array(path, dtype, length, mode='r'):
+    if not length:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode=mode, shape=(length,))
+
+
+# replaces the file so that live memory maps keep reading the old copy
+def write_array(path, array, dtype):
+    with open(path + '.tmp', 'wb') as fh:
+        fh.write(np.ascontiguousarray(array, dtype=dtype).tobytes())
+    os.replace(path + '.tmp', path)
+
+
+# writes rows after the first offset rows, dropping anything left past them
+def append_array(path, array, dtype, offset):
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as fh:
+        fh.seek(offset * np.dtype(dtype).itemsize)
+        fh.write(np.ascontiguousarray(array, dtype=dtype).tobytes())
+        fh.truncate()
+
+
+def read_store(folder):
+    manifest = read_manifest(folder)
+    if not manifest:
+        return empty_store()
+    length = manifest['length']
+    index = read_array(os.path.join(folder, INDEX), INDEX_DTYPE, length)
+    columns = {
+        column: read_array(os.path.join(folder, file_name), COLUMN_DTYPE, length)
+        for column, file_name in manifest['columns']
+    }
+    return index, columns
+
+
+def read_array_tail(path, dtype, length, rows):
+    rows = min(rows, length)
+    with open(path, 'rb') as fh:
+        fh.seek((length - rows) * np.dtype(dtype).itemsize)
+        return np.fromfile(fh, dtype=dtype, count=rows)
+
+
+# the last rows of the store's columns that are asked for, read without mapping
+# or loading the rest of it
+def read_store_tail(folder, rows, columns):
+    manifest = read_manifest(folder)
+    if not manifest:
+        return empty_store()
+    length = manifest['length']
+    index = read_array_tail(os.path.join(folder, INDEX), INDEX_DTYPE, length, rows)
+    return index, {
+        column: read_array_tail(os.path.join(folder, file_name), COLUMN_DTYPE, length, rows)
+        for column, file_name in manifest['columns'] if column in columns
+    }
+
+
+def write_store(folder, index, columns):
+    make_path(get_manifest_path(folder))
+    files = [(column, '%s.f8' % i) for i, column in enumerate(columns)]
+    write_array(os.path.join(folder, INDEX), index, INDEX_DTYPE)
+    for column, file_name in files:
+        write_array(os.path.join(folder, file_name), columns[column], COLUMN_DTYPE)
+    write_manifest(folder, {'columns': files, 'length': len(index)})
+
+
+def append_store(folder, index, columns):
+    manifest = read_manifest(folder)
+    if not manifest:
+        return write_store(folder, index, columns)
+    length = manifest['length']
+    old_index = read_array(os.path.join(folder, INDEX), INDEX_DTYPE, length)
+    if length and len(index) and index[0] <= old_index[-1]:
+        raise ValueError('Appended rows must come after the last stored date')
+    append_array(os.path.join(folder, INDEX), index, INDEX_DTYPE, length)
+    for column, file_name in manifest['columns']:
+        values = columns.get(column, np.full(len(index), np.nan))
+        append_array(os.path.join(folder, file_name), values, COLUMN_DTYPE, length)
+    manifest['length'] = length + len(index)
+    write_manifest(folder, manifest)
+
+
+def to_float(value):
+    if value is None or value == '':
+        return np.nan
+    return float(value)
+
+
+def dict_to_arrays(data):
+    dates = sorted(data)
+    index = dates_to_days(dates).astype(INDEX_DTYPE)
+    columns = {}
+    for i, date in enumerate(dates):
+        for column, value in data[date].items():
+            if column not in columns:
+                columns[column] = np.full(len(dates), np.nan)
+            columns[column][i] = to_float(value)
+    return index, columns
+
+
+# merges { date: { column: value } } into the store, appending new trailing rows,
+# writing new columns and updating only changed cells in place; the whole store
+# is only rewritten when new dates fall before the last stored date
+def merge_store(folder, data):
+    if not data:
+        return
+    new_index, new_columns = dict_to_arrays(data)
+    manifest = read_manifest(folder)
+    index, columns = read_store(folder)
+    if not manifest or not len(index):
+        return write_store(folder, new_index, new_columns)
+
+    tail = new_index > index[-1]
+    positions = np.searchsorted(index, new_index[~tail])
+    if not np.array_equal(index[positions], new_index[~tail]):
+        return rewrite_store(folder, index, columns, new_index, new_columns)
+
+    length = len(index)
+    files = dict(manifest['columns'])
+    for column, values in new_columns.items():
+        head = values[~tail]
+        if column in files:
+            update = ~np.isnan(head) & (head != columns[column][positions])
+            if update.any():
+                array = read_array(os.path.join(folder, files[column]), COLUMN_DTYPE, length, 'r+')
+                array[positions[update]] = head[update]
+                array.flush()
+                del array
+        else:
+            array = np.full(length, np.nan)
+            array[positions] = head
+            files[column] = '%s.f8' % len(manifest['columns'])
+            manifest['columns'].append([column, files[column]])
+            write_array(os.path.join(folder, files[column]), array, COLUMN_DTYPE)
+
+    if tail.any():
+        append_array(os.path.join(folder, INDEX), new_index[tail], INDEX_DTYPE, length)
+        for column, file_name in manifest['columns']:
+            values = new_columns[column][tail] if column in new_columns else np.full(tail.sum(), np.nan)
+            append_array(os.path.join(folder, file_name), values, COLUMN_DTYPE, length)
+        manifest['length'] = length + int(tail.sum())
+    write_manifest(folder, manifest)
+
+
+def rewrite_store(folder, index, columns, new_index, new_columns):
+    merged_index = np.union1d(index, new_index).astype(INDEX_DTYPE)
+    old_positions = np.searchsorted(merged_index, index)
+    new_positions = np.searchsorted(merged_index, new_index)
+    merged = {}
+    for column in list(columns) + [c for c in new_columns if c not in columns]:
+        array = np.full(len(merged_index), np.nan)
+        if column in columns:
+            array[old_positions] = columns[column]
+        if column in new_columns:
+            values = new_columns[column]
+            update = ~np.isnan(values)
+            array[new_positions[update]] = values[update]
+        merged[column] = array
+    write_store(folder, merged_index, merged)
+
+
+# inclusive, returns views of the stored arrays
+def slice_store(index, columns, start, end):
+    lo = np.searchsorted(index, date_to_day(start), side='left')
+    hi = np.searchsorted(index, date_to_day(end), side='right')
+    return index[lo:hi], {column: values[lo:hi] for column, values in columns.items()}
+
+
+def store_to_dict(index, columns):
+    dates = [day_to_date(day) for day in index.tolist()]
+    values = [(column, array.tolist()) for column, array in columns.items()]
+    return {
+        date: {
+            column: '' if column_values[i] != column_values[i] else column_values[i]
+            for column, column_values in values
+        } for i, date in enumerate(dates)
+    }
+
+
+# changes whenever the manifest is replaced, which every write ends with
+def get_store_version(folder):
+    try:
+        stat = os.stat(get_manifest_path(folder))
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+    except FileNotFoundError:
+        return
+
+
+# reads the whole store into read only arrays which readers slice views from
+def load_store(folder):
+    index, columns = read_store(folder)
+    index = np.array(index)
+    columns = {column: np.array(values) for column, values in columns.items()}
+    for array in [index] + list(columns.values()):
+        array.flags.writeable = False
+    return index, columns
+
+
+def get_store_size(index, columns):
+    return index.nbytes + sum(values.nbytes for values in columns.values())
+
+
+# loaded stores shared by every reader in the process, reloaded when the store
+# on disk changes and evicted least recently used first past max_bytes
+class StoreCache:
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, folder):
+        version = get_store_version(folder)
+        if version is None:
+            return empty_store()
+        with self.lock:
+            entry = self.entries.get(folder)
+            if entry and entry[0] == version:
+                self.entries.move_to_end(folder)
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+        index, columns = load_store(folder)
+        with self.lock:
+            self.remove(folder)
+            self.entries[folder] = (version, index, columns, get_store_size(index, columns))
+            self.size += self.entries[folder][3]
+            # the newest store is kept even when it is larger than max_bytes
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                self.remove(next(iter(self.entries)))
+        return index, columns
+
+    def remove(self, folder):
+        entry = self.entries.pop(folder, None)
+        if entry:
+            self.size -= entry[3]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'stores': len(self.entries), 'bytes': self.size}
+
+
+def get_store_cache():
+    global CACHE
+    with CACHE_LOCK:
+        if CACHE is None:
+            CACHE = StoreCache(PARAMS['store_cache_bytes'])
+        return CACHE
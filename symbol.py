@@ -1,13 +1,21 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
 from urllib.parse import urlencode
-import requests
 import csv
-from data import Data
+import client
+from data import Data, get_data_path
+from store import MANIFEST, read_manifest, write_manifest, get_store_cache, merge_store, store_exists, store_to_dict, \
+    to_float
+from frame import SymbolFrame
+from schema import get_column_key
+from technical import can_calculate, calculate_symbol_data
+from download import get_limiter, download_map, map_concurrently
 from utility import *
 from params import PARAMS
 
 API_KEY = PARAMS['credentials']['alphavantage']
 DAILY_OPTIONS = PARAMS['data_options']['daily']()
+COMPACT_SIZE = 100
+MIGRATED = set()
 
 
 class SymbolData(Data):
@@ -17,52 +25,69 @@ class SymbolData(Data):
         self.options_list = params['options_list']
         self.start = params.get('start', None)
         self.end = params.get('end', None)
-        self.all_data = {}
-        super().__init__(symbol=self.symbol)
-        self.params = params
-        self.write_params()
+        self.index = None
+        self.columns = {}
+        super().__init__(**params)
 
     def get_folder(self):
         return 'symbol'
 
+    # every options list of a symbol shares one store
+    def get_key_params(self):
+        return {'symbol': self.symbol}
+
     def get_symbol_path(self):
-        return self.get_path(self.symbol + '.csv')
+        return self.get_path(self.symbol)
 
     def write_data(self):
-        write_symbol_data(self.get_all_data(), self.get_symbol_path())
+        # downloaded data is merged into the store by download_data
+        pass
 
     def get_all_data(self):
-        if not self.all_data:
+        if self.index is None:
             self.get_data()
-        return self.all_data
+        return store_to_dict(self.index, self.columns)
 
     def read_data(self):
-        self.all_data = self.read_all_data()
+        self.read_all_data()
         self.refresh_data()
-        if self.all_data:
-            data = self.filter_data(self.all_data)
-            return data
+        if len(self.index):
+            return self.filter_data()
 
-    def filter_data(self, data):
-        return filter_data(data, self.options_list, self.start, self.end)
+    def filter_data(self):
+        return filter_data(self.index, self.columns, self.options_list, self.start, self.end)
+
+    # the same rows as get_data without building dicts
+    def get_frame(self):
+        if self.index is None:
+            self.get_data()
+        return get_symbol_frame(self.index, self.columns, self.options_list, self.start, self.end)
 
     def read_all_data(self):
-        return read_symbol_data(self.get_symbol_path())
+        self.index, self.columns = read_symbol_store(self.get_symbol_path())
 
+    # read_data downloaded what it could, so only columns still missing are asked for
     def get_new_data(self):
-        data = download_symbol_data(self.symbol, self.options_list)
-        dict_merge(self.all_data, data)
-        return self.filter_data(data)
-
-    def refresh_data(self, update_old=False):
-        missing_columns = get_missing_columns(self.all_data, self.options_list)
-        if update_old:
-            missing_columns += get_old_columns(self.all_data)
+        missing_options = columns_to_options(get_missing_columns(list(self.columns), self.options_list))
+        if missing_options:
+            self.download_data(missing_options)
+        return self.filter_data()
+
+    def download_data(self, options_list, incremental=False):
+        self.index, self.columns = download_symbol_store(self.symbol, self.get_symbol_path(), options_list, incremental)
+
+    def refresh_data(self, update_old=False, incremental=True):
+        missing_columns = get_missing_columns(list(self.columns), self.options_list)
+        if update_old and not incremental:
+            missing_columns += get_old_columns(self.index, self.columns)
         missing_options = columns_to_options(missing_columns)
         if missing_options:
-            new_data = download_symbol_data(self.symbol, missing_options)
-            dict_merge(self.all_data, new_data)
-            self.write_data()
+            self.download_data(missing_options)
+        if update_old and incremental:
+            old_columns = list_subtract(get_old_columns(self.index, self.columns), missing_columns)
+            old_options = columns_to_options(old_columns)
+            if old_options:
+                self.download_data(old_options, incremental=True)
 
 
 class SymbolCloseData(SymbolData):
@@ -77,8 +102,41 @@ class SymbolCloseData(SymbolData):
             self.data = filter_close(data)
         return self.data
 
-
-def download_symbol_datum(symbol, options):
+    # a frame with the close prices in a column named close
+    def get_frame(self):
+        close_id = get_close_id()
+        return super().get_frame().select([close_id]).rename({close_id: 'close'})
+
+
+# indicators are calculated from the daily data when local_indicators is set,
+# and with incremental set only the rows after the stored data are downloaded
+def download_symbol_store(symbol, folder, options_list, incremental=False):
+    index, columns = get_store_cache().get(folder)
+    calculated, downloaded = split_calculated(options_list, columns)
+    if incremental:
+        data_iter = download_map(lambda o: download_symbol_tail(symbol, o, index, columns), downloaded)
+    else:
+        data_iter = download_symbol_data_iter(symbol, downloaded)
+    for data in data_iter:
+        merge_store(folder, data)
+    if calculated:
+        index, columns = get_store_cache().get(folder)
+        merge_store(folder, calculate_symbol_data(index, columns, calculated))
+    return get_store_cache().get(folder)
+
+
+# the options calculated locally and those downloaded, which include the daily
+# options when the calculated ones need them
+def split_calculated(options_list, columns):
+    calculated = [o for o in options_list if PARAMS['local_indicators'] and can_calculate(o)]
+    downloaded = [o for o in options_list if o not in calculated]
+    if (calculated and DAILY_OPTIONS not in downloaded
+            and get_missing_columns(list(columns), [DAILY_OPTIONS])):
+        downloaded.append(DAILY_OPTIONS)
+    return calculated, downloaded
+
+
+def download_symbol_datum(symbol, options, overrides=None):
     options = {
         key: value for key, value in options.items() if value is not 'columns'
     }
@@ -86,7 +144,7 @@ def download_symbol_datum(symbol, options):
     data = request({**{
         'symbol': symbol,
         'apikey': API_KEY
-    }, **options})
+    }, **options, **(overrides or {})})
     data = sanitize_data(data)
     data = convert_data(data, options)
     return data
@@ -94,15 +152,75 @@ def download_symbol_datum(symbol, options):
 
 def download_symbol_data(symbol, options_list):
     data = {}
-    for options in options_list:
-        new_data = download_symbol_datum(symbol, options)
+    for new_data in download_symbol_data_iter(symbol, options_list):
         dict_merge(data, new_data)
     return data
 
 
+# downloads options concurrently, yielding each one's data as it arrives
+def download_symbol_data_iter(symbol, options_list):
+    return download_map(lambda options: download_symbol_datum(symbol, options), options_list)
+
+
+# downloads the rows after the last stored date, asking only for the compact
+# output when it reaches back far enough, and falls back to the full history
+# when the rows both hold no longer match
+def download_symbol_tail(symbol, options, index, columns):
+    column_ids = [column_id for _, column_id in get_column_ids(options)]
+    last_date = get_last_date(index, columns, column_ids)
+    if last_date is None:
+        return download_symbol_datum(symbol, options)
+    overrides = {}
+    if 'outputsize' in options and count_weekdays(last_date, get_latest_weekday()) < COMPACT_SIZE:
+        overrides['outputsize'] = 'compact'
+    data = download_symbol_datum(symbol, options, overrides)
+    if not verify_overlap(index, columns, data, last_date):
+        log('Stored %s data for %s changed, downloading all of it...' % (options['function'], symbol))
+        return download_symbol_datum(symbol, options)
+    return {date: datum for date, datum in data.items() if date > last_date}
+
+
+# latest date for which every column has a value
+def get_last_date(index, columns, column_ids):
+    days = [get_last_day(index, columns[column]) for column in column_ids if column in columns]
+    if len(days) < len(column_ids) or None in days:
+        return None
+    return day_to_date(min(days))
+
+
+def get_last_day(index, values):
+    valid = np.flatnonzero(~np.isnan(values))
+    return int(index[valid[-1]]) if len(valid) else None
+
+
+def count_weekdays(start, end):
+    return int(np.busday_count(start, end))
+
+
+# the downloaded rows up to last_date must reach back to it and match what is stored
+def verify_overlap(index, columns, data, last_date):
+    overlap = {date: datum for date, datum in data.items() if date <= last_date}
+    if last_date not in overlap:
+        return False
+    days = np.array([date_to_day(date) for date in overlap], dtype=index.dtype)
+    positions = np.searchsorted(index, days)
+    stored = positions < len(index)
+    stored[stored] = index[positions[stored]] == days[stored]
+    for (date, datum), position, is_stored in zip(overlap.items(), positions, stored):
+        if not is_stored:
+            return False
+        for column, value in datum.items():
+            if column in columns:
+                old_value = columns[column][position]
+                new_value = to_float(value)
+                if old_value == old_value and not np.isclose(old_value, new_value, rtol=1e-9, atol=0):
+                    return False
+    return True
+
+
 def request(options):
-    url = 'https://www.alphavantage.co/query?%s' % urlencode(options)
-    data = requests.get(url).json()
+    url = '%s?%s' % (PARAMS['alphavantage_url'], urlencode(options))
+    data = client.get_json('alphavantage', url, client.is_alphavantage_throttled, get_limiter())
     if 'Error Message' in data:
         raise Exception(data['Error Message'])
     data = next(data[key] for key in data.keys() if key != 'Meta Data')
@@ -118,72 +236,144 @@ def sanitize_datum(datum):
 
 
 def convert_data(data, options):
-    columns = encrypt_options(options)
+    columns = get_column_ids(options)
     return {
         date: {
-            column_hash: data[date][column]
-            for column, column_hash in columns if column in data[date]
+            column_id: data[date][column]
+            for column, column_id in columns if column in data[date]
         } for date in data.keys()
     }
 
 
-def json_to_csv(data, date, headers):
-    return [date] + list(map(lambda col: data[date].get(col, ""), headers[1:]))
-
-
 def csv_to_json(datum):
     date = datum['Date']
     del datum['Date']
     return {date: datum}
 
 
+# the options the columns were downloaded with, each once in the order first seen
 def columns_to_options(columns):
-    options_list = [decrypt_dict(column) for column in columns]
-    for options in options_list:
+    schema = get_schema()
+    options_list = {}
+    for column in columns:
+        options = schema.get_options(column)
         del options['column']
-    return remove_duplicates(options_list)
+        options_list.setdefault(get_column_key(options), options)
+    return list(options_list.values())
 
 
-def get_old_columns(data):
-    dates = sorted(data, reverse=True)
-    if len(dates) == 0:
+# columns without a value for the latest weekday
+def get_old_columns(index, columns):
+    if len(index) == 0:
         return []
-    # check latest data against date
-    if dates[0] != get_latest_weekday():
-        return get_columns(data)
-    # check missing data
-    columns = set()
-    for date in dates:
-        old_columns = [k for k, v in data[date].items() if v == '']
-        if len(old_columns) > 0:
-            columns.update(old_columns)
-        else:
-            break
-    return list(columns)
-
-
-def get_missing_columns(data, options_list):
-    present_columns = get_columns(data)
-    columns = list(map(lambda c: c[1], encrypt_options_list(options_list)))
+    latest_day = date_to_day(get_latest_weekday())
+    return [column for column, values in columns.items()
+            if (get_last_day(index, values) or 0) < latest_day]
+
+
+def get_missing_columns(present_columns, options_list):
+    columns = list(map(lambda c: c[1], get_column_ids_list(options_list)))
     missing_columns = list_subtract(columns, present_columns)
     return missing_columns
 
 
-def get_portfolio_data(symbols, options_list, start, end, refresh):
-    data = {}
-    for symbol in symbols:
-        data[symbol] = SymbolData(symbol=symbol, options_list=options_list, start=start, end=end)
-        data[symbol].refresh_data(update_old=refresh)
+def get_symbol_data(symbol, options_list, start, end, refresh):
+    data = SymbolData(symbol=symbol, options_list=options_list, start=start, end=end)
+    data.refresh_data(update_old=refresh)
     return data
 
 
-def write_symbol_data(data, path):
-    with open(path, 'w') as outfile:
-        csv_file = csv.writer(outfile)
-        columns = ['Date'] + get_columns(data)
-        csv_file.writerow(columns)
-        for date in sorted(data):
-            csv_file.writerow(json_to_csv(data, date, columns))
+def get_symbol_folder(symbol):
+    return os.path.join(get_data_path('symbol', {'symbol': symbol}), symbol)
+
+
+def read_symbol_store(folder):
+    csv_path = folder + '.csv'
+    if not store_exists(folder) and os.path.exists(csv_path):
+        migrate_symbol_csv(csv_path, folder)
+    migrate_column_names(folder)
+    return get_store_cache().get(folder)
+
+
+def get_portfolio_data(symbols, options_list, start, end, refresh):
+    symbols = list(dict.fromkeys(symbols))
+    return dict(zip(symbols, get_portfolio_plan(symbols, options_list, start, end, refresh).execute()))
+
+
+def get_portfolio_plan(symbols, options_list, start, end, refresh):
+    return FetchPlan([{'symbol': s, 'options_list': options_list, 'start': start, 'end': end}
+                      for s in dict.fromkeys(symbols)], refresh)
+
+
+# the downloads a set of SymbolData params needs, worked out from the stores
+# before any is made, with the options every symbol is asked for merged so that
+# each column is downloaded once however many requests share it
+class FetchPlan:
+
+    def __init__(self, requests, refresh=False):
+        self.requests = requests
+        options_lists = {}
+        for request in requests:
+            options_lists.setdefault(request['symbol'], []).extend(request['options_list'])
+        self.options = {symbol: get_symbol_options(read_symbol_store(get_symbol_folder(symbol)), options_list, refresh)
+                        for symbol, options_list in options_lists.items()}
+
+    # every call as (symbol, function, incremental)
+    def get_calls(self):
+        return [(symbol, options['function'], incremental)
+                for symbol, (_, calls) in self.options.items()
+                for incremental in (False, True) for options in calls[incremental]]
+
+    def get_cost(self):
+        calls = self.get_calls()
+        incremental = sum(1 for _, _, i in calls if i)
+        return {
+            'symbols': len({symbol for symbol, _, _ in calls}),
+            'calls': len(calls),
+            'full': len(calls) - incremental,
+            'incremental': incremental,
+            'minutes': len(calls) / PARAMS['download']['requests_per_minute'],
+            'days': len(calls) / PARAMS['download']['daily_quota']
+        }
+
+    # downloads the plan, then reads each request's data from the stores, a
+    # symbol's requests one after another since each can merge into its store
+    def execute(self):
+        symbols = [symbol for symbol, (options, _) in self.options.items() if options[False] or options[True]]
+        map_concurrently(self.download, symbols)
+        groups = {}
+        for i, request in enumerate(self.requests):
+            groups.setdefault(request['symbol'], []).append(i)
+        data = {}
+        for group in map_concurrently(self.read_requests, groups.values()):
+            data.update(group)
+        return [data[i] for i in range(len(self.requests))]
+
+    def read_requests(self, indices):
+        return {i: SymbolData(**self.requests[i]) for i in indices}
+
+    def download(self, symbol):
+        folder = get_symbol_folder(symbol)
+        options, _ = self.options[symbol]
+        for incremental in (False, True):
+            if options[incremental]:
+                download_symbol_store(symbol, folder, options[incremental], incremental)
+
+
+# the options to get for the options_list columns missing from the store, and
+# with refresh for the rows after the stored ones of the columns without a value
+# for the latest weekday, keyed by incremental, along with the options of those
+# downloaded since options calculated locally take no call
+def get_symbol_options(store, options_list, refresh):
+    index, columns = store
+    missing = get_missing_columns(list(columns), options_list)
+    options = {False: columns_to_options(missing), True: []}
+    if refresh:
+        wanted = {column_id: columns[column_id] for _, column_id in get_column_ids_list(options_list)
+                  if column_id in columns}
+        options[True] = columns_to_options(list_subtract(get_old_columns(index, wanted), missing))
+    calls = {incremental: split_calculated(options[incremental], columns)[1] for incremental in options}
+    return options, calls
 
 
 def read_symbol_data(path):
@@ -199,13 +389,61 @@ def read_symbol_data(path):
         return {}
 
 
-def filter_data(data, options_list, start, end):
-    columns = list(map(lambda c: c[1], encrypt_options_list(options_list)))
-    data = filter_columns(columns, data)
-    if start and end:
-        data = filter_dates(data, start, end)
-    data = filter_incomplete(data)
-    return data
+def migrate_symbol_csv(csv_path, folder):
+    log('Migrating %s...' % csv_path)
+    merge_store(folder, read_symbol_data(csv_path))
+
+
+# stores written before the schema registry named their columns by the
+# encrypted options, which are swapped for the columns' ids
+def migrate_column_names(folder):
+    if folder in MIGRATED:
+        return
+    manifest = read_manifest(folder)
+    if manifest and any(type(column) is str for column, _ in manifest['columns']):
+        log('Migrating %s column names...' % folder)
+        schema = get_schema()
+        manifest['columns'] = [
+            [schema.get_key_id(decrypt_dict(column)) if type(column) is str else column, file_name]
+            for column, file_name in manifest['columns']
+        ]
+        write_manifest(folder, manifest)
+    MIGRATED.add(folder)
+
+
+# one-shot conversion of every cached CSV file to the columnar store
+def migrate_symbol_data():
+    root = os.path.join(os.getcwd(), PARAMS['data_folder'], 'symbol')
+    for folder, _, files in os.walk(root):
+        for file_name in files:
+            if file_name.endswith('.csv'):
+                store_folder = os.path.join(folder, file_name[:-len('.csv')])
+                if not store_exists(store_folder):
+                    migrate_symbol_csv(os.path.join(folder, file_name), store_folder)
+    for folder, _, files in os.walk(root):
+        if MANIFEST in files:
+            migrate_column_names(folder)
+
+
+# the symbols with a store in the data folder
+def get_cached_symbols():
+    root = os.path.join(os.getcwd(), PARAMS['data_folder'], 'symbol')
+    if not os.path.exists(root):
+        return []
+    symbols = []
+    for folder, names, _ in os.walk(root):
+        symbols += [name for name in names if store_exists(os.path.join(folder, name))]
+    return sorted(set(symbols))
+
+
+def get_symbol_frame(index, columns, options_list, start, end):
+    keep = list(map(lambda c: c[1], get_column_ids_list(options_list)))
+    frame = SymbolFrame(index, {column: columns[column] for column in keep if column in columns})
+    return frame.slice(start, end).dropna()
+
+
+def filter_data(index, columns, options_list, start, end):
+    return get_symbol_frame(index, columns, options_list, start, end).to_dict()
 
 
 def add_symbol_args(parser):
@@ -224,6 +462,7 @@ def add_args(parser):
     parser.add_argument('-o', '--options', type=str, nargs='+', required=True,
                         help='indices of data_options in params.py')
     parser.add_argument('-r', '--refresh', action='store_true', help='refresh the data')
+    parser.add_argument('--dry_run', action='store_true', help='print the calls the data needs without making them')
 
 
 def handle_symbol_args(args, parser):
@@ -249,6 +488,9 @@ def handle_args(args, parser):
 
 def main():
     args = parse_args('Load symbol data.', add_args, handle_args)
+    if args.dry_run:
+        return log(get_portfolio_plan(args.symbols, args.options_list, args.start, args.end,
+                                      args.refresh).get_cost(), force=True)
     data = get_portfolio_data(args.symbols, args.options_list, args.start, args.end, args.refresh)
     log({k: v.get_data() for k, v in data.items()}, force=args.print)
     if args.path:
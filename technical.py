@@ -0,0 +1,261 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from scipy.signal import lfilter
+from utility import *
+
+DAILY_OPTIONS = PARAMS['data_options']['daily']()
+
+
+# indicators follow the TA-Lib definitions used by AlphaVantage, including their
+# seeding and lookback periods, and are NaN until enough history is available
+def rolling_window(a, window):
+    a = np.ascontiguousarray(a)
+    shape = (max(len(a) - window + 1, 0), window)
+    return as_strided(a, shape=shape, strides=(a.strides[0], a.strides[0]), writeable=False)
+
+
+def pad(values, length):
+    out = np.full(length, np.nan)
+    if len(values):
+        out[length - len(values):] = values
+    return out
+
+
+def rolling_sum(a, period):
+    sums = np.cumsum(np.insert(a, 0, 0.0))
+    return pad(sums[period:] - sums[:-period], len(a))
+
+
+def calc_sma(a, period):
+    return rolling_sum(a, period) / period
+
+
+# y[t] = alpha * x[t] + (1 - alpha) * y[t - 1], starting from seed at index start
+def smooth(a, alpha, seed, start, gain=None):
+    out = np.full(len(a), np.nan)
+    if start >= len(a):
+        return out
+    out[start] = seed
+    if start + 1 < len(a):
+        b = [alpha if gain is None else gain]
+        out[start + 1:] = lfilter(b, [1, alpha - 1], a[start + 1:], zi=[(1 - alpha) * seed])[0]
+    return out
+
+
+# seeded with the simple average of the period values ending at start
+def calc_ema(a, period, start=None):
+    start = period - 1 if start is None else start
+    if start >= len(a) or start < period - 1:
+        return np.full(len(a), np.nan)
+    seed = np.mean(a[start - period + 1:start + 1])
+    return smooth(a, 2.0 / (period + 1), seed, start)
+
+
+def calc_ma(a, period, ma_type):
+    if int(ma_type) == 0:
+        return calc_sma(a, period)
+    elif int(ma_type) == 1:
+        return calc_ema(a, period)
+    raise ValueError('Unsupported moving average type: %s' % ma_type)
+
+
+# moving averages of series which start with NaNs
+def calc_ma_from(a, period, ma_type):
+    start = first_valid(a)
+    out = np.full(len(a), np.nan)
+    out[start:] = calc_ma(a[start:], period, ma_type)
+    return out
+
+
+def first_valid(a):
+    valid = np.flatnonzero(~np.isnan(a))
+    return valid[0] if len(valid) else len(a)
+
+
+def sma(prices, options):
+    return {'SMA': calc_sma(prices[options['series_type']], int(options['time_period']))}
+
+
+def ema(prices, options):
+    return {'EMA': calc_ema(prices[options['series_type']], int(options['time_period']))}
+
+
+def macd(prices, options):
+    a = prices[options['series_type']]
+    fast = int(options['fastperiod'])
+    slow = int(options['slowperiod'])
+    signal = int(options['signalperiod'])
+    if fast > slow:
+        fast, slow = slow, fast
+    # both averages start where the slow one has enough history
+    line = calc_ema(a, fast, slow - 1) - calc_ema(a, slow, slow - 1)
+    signal_line = np.full(len(a), np.nan)
+    signal_line[slow - 1:] = calc_ema(line[slow - 1:], signal)
+    line[np.isnan(signal_line)] = np.nan
+    return {'MACD': line, 'MACD_Signal': signal_line, 'MACD_Hist': line - signal_line}
+
+
+def stoch(prices, options):
+    high, low, close = prices['high'], prices['low'], prices['close']
+    period = int(options['fastkperiod'])
+    highest = pad(rolling_window(high, period).max(axis=1), len(close))
+    lowest = pad(rolling_window(low, period).min(axis=1), len(close))
+    diff = highest - lowest
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fast_k = np.where(diff > 0, (close - lowest) / diff * 100, 0.0)
+    fast_k[np.isnan(diff)] = np.nan
+    slow_k = calc_ma_from(fast_k, int(options['slowkperiod']), options['slowkmatype'])
+    slow_d = calc_ma_from(slow_k, int(options['slowdperiod']), options['slowdmatype'])
+    slow_k[np.isnan(slow_d)] = np.nan
+    return {'SlowK': slow_k, 'SlowD': slow_d}
+
+
+def rsi(prices, options):
+    a = prices[options['series_type']]
+    period = int(options['time_period'])
+    out = np.full(len(a), np.nan)
+    if len(a) <= period:
+        return {'RSI': out}
+    diff = np.diff(a)
+    gains = np.maximum(diff, 0)
+    losses = np.maximum(-diff, 0)
+    alpha = 1.0 / period
+    avg_gain = smooth(gains, alpha, gains[:period].mean(), period - 1)
+    avg_loss = smooth(losses, alpha, losses[:period].mean(), period - 1)
+    total = avg_gain + avg_loss
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out[1:] = np.where(total > 0, 100 * avg_gain / total, 0.0)
+    out[:period] = np.nan
+    return {'RSI': out}
+
+
+def directional_movement(high, low, close):
+    up = np.diff(high)
+    down = -np.diff(low)
+    plus_dm = np.where((up > 0) & (up > down), up, 0.0)
+    minus_dm = np.where((down > 0) & (down > up), down, 0.0)
+    true_range = np.maximum.reduce([high[1:] - low[1:],
+                                    np.abs(high[1:] - close[:-1]),
+                                    np.abs(low[1:] - close[:-1])])
+    return plus_dm, minus_dm, true_range
+
+
+# running sums which drop 1 / period of their value every step
+def wilder_sum(a, period):
+    seed = a[:period - 1].sum()
+    alpha = 1.0 / period
+    out = np.full(len(a), np.nan)
+    out[period - 1:] = smooth(np.insert(a[period - 1:], 0, seed), alpha, seed, 0, gain=1.0)[1:]
+    return out
+
+
+def adx(prices, options):
+    high, low, close = prices['high'], prices['low'], prices['close']
+    period = int(options['time_period'])
+    out = np.full(len(close), np.nan)
+    if len(close) < 2 * period:
+        return {'ADX': out}
+    plus_dm, minus_dm, true_range = directional_movement(high, low, close)
+    plus_dm = wilder_sum(plus_dm, period)
+    minus_dm = wilder_sum(minus_dm, period)
+    true_range = wilder_sum(true_range, period)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        plus_di = np.where(true_range > 0, 100 * plus_dm / true_range, 0.0)
+        minus_di = np.where(true_range > 0, 100 * minus_dm / true_range, 0.0)
+        total = plus_di + minus_di
+        dx = np.where(total > 0, 100 * np.abs(plus_di - minus_di) / total, 0.0)
+    dx = dx[period - 1:]
+    out[2 * period - 1:] = smooth(dx, 1.0 / period, dx[:period].mean(), period - 1)[period - 1:]
+    return {'ADX': out}
+
+
+def cci(prices, options):
+    period = int(options['time_period'])
+    typical = (prices['high'] + prices['low'] + prices['close']) / 3
+    windows = rolling_window(typical, period)
+    average = windows.mean(axis=1)
+    deviation = np.abs(windows - average[:, None]).mean(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values = np.where(deviation > 0, (typical[period - 1:] - average) / (0.015 * deviation), 0.0)
+    return {'CCI': pad(values, len(typical))}
+
+
+def aroon(prices, options):
+    period = int(options['time_period'])
+    length = len(prices['close'])
+    # ties go to the most recent day, so search the reversed windows
+    highs = rolling_window(prices['high'], period + 1)[:, ::-1]
+    lows = rolling_window(prices['low'], period + 1)[:, ::-1]
+    up = 100.0 * (period - highs.argmax(axis=1)) / period
+    down = 100.0 * (period - lows.argmin(axis=1)) / period
+    return {'Aroon Up': pad(up, length), 'Aroon Down': pad(down, length)}
+
+
+def bbands(prices, options):
+    a = prices[options['series_type']]
+    period = int(options['time_period'])
+    middle = calc_ma(a, period, options['matype'])
+    deviation = pad(rolling_window(a, period).std(axis=1), len(a))
+    return {
+        'Real Middle Band': middle,
+        'Real Upper Band': middle + float(options['nbdevup']) * deviation,
+        'Real Lower Band': middle - float(options['nbdevdn']) * deviation
+    }
+
+
+def ad(prices, options):
+    high, low, close, volume = prices['high'], prices['low'], prices['close'], prices['volume']
+    diff = high - low
+    with np.errstate(invalid='ignore', divide='ignore'):
+        flow = np.where(diff > 0, ((close - low) - (high - close)) / diff * volume, 0.0)
+    return {'Chaikin A/D': np.cumsum(flow)}
+
+
+def obv(prices, options):
+    close, volume = prices['close'], prices['volume']
+    direction = np.sign(np.diff(close))
+    return {'OBV': np.cumsum(np.insert(direction * volume[1:], 0, volume[0]))}
+
+
+CALCULATORS = {
+    'SMA': sma,
+    'EMA': ema,
+    'MACD': macd,
+    'STOCH': stoch,
+    'RSI': rsi,
+    'ADX': adx,
+    'CCI': cci,
+    'AROON': aroon,
+    'BBANDS': bbands,
+    'AD': ad,
+    'OBV': obv
+}
+
+
+def can_calculate(options):
+    return options['function'] in CALCULATORS
+
+
+def calculate_datum(prices, options):
+    return CALCULATORS[options['function']](prices, options)
+
+
+# calculates indicators from the stored daily columns and returns them in the
+# same { date: { column id: value } } shape as a download
+def calculate_symbol_data(index, columns, options_list):
+    daily = get_column_ids(DAILY_OPTIONS)
+    if not len(index) or not all(column_id in columns for _, column_id in daily):
+        return {}
+    prices = {column: np.asarray(columns[column_id], dtype=np.float64) for column, column_id in daily}
+    valid = ~np.any([np.isnan(values) for values in prices.values()], axis=0)
+    prices = {column: values[valid] for column, values in prices.items()}
+    dates = [day_to_date(day) for day in np.asarray(index)[valid].tolist()]
+    data = {}
+    for options in options_list:
+        log('Calculating %s data...' % options['function'])
+        values = calculate_datum(prices, options)
+        for column, column_id in get_column_ids(options):
+            for date, value in zip(dates, values[column].tolist()):
+                if value == value:
+                    data.setdefault(date, {})[column_id] = value
+    return data
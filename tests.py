@@ -1,11 +1,35 @@
 import unittest
 import shutil
+import tempfile
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qsl
+import neural
 from neural import NeuralNetwork
-from symbol import SymbolData
+from data import Data, DataException, get_data_path, get_legacy_name
+from symbol import SymbolData, SymbolCloseData
 from optimal import *
+import preprocess
 from preprocess import NeuralNetworkData, stratify_parts
 from graph import OptimalTradesGraph
+import screener
 from screener import yahoo
+from store import *
+import technical
+import indicators
+import download
+import client
+import jobs
+import symbol
+from symbol import DAILY_OPTIONS, download_symbol_data, verify_overlap
+from schema import Schema
+from frame import SymbolFrame
+from panel import Panel
+import screen
+import serve
+import train
 
 
 class TestOptimal(unittest.TestCase):
@@ -98,17 +122,53 @@ class TestOptimal(unittest.TestCase):
         self.assertEqual(smooth_trades(trades, prices), trades)
 
 
-def remove_last_line(path):
-    file = open(path, 'r+', encoding='utf-8')
-    file.seek(0, os.SEEK_END)
-    pos = file.tell() - 1
-    while pos > 0 and file.read(1) != "\n":
-        pos -= 2
-        file.seek(pos, os.SEEK_SET)
-    if pos > 0:
-        file.seek(pos, os.SEEK_SET)
-        file.truncate()
-    file.close()
+def signals_to_trades(signals):
+    return {int(i): int(signals[i]) for i in np.flatnonzero(signals)}
+
+
+class TestLabelTrades(unittest.TestCase):
+
+    def test_matches_optimize_trades(self):
+        cases = [([10, 20, 19, 30, 10, 15], 0), ([10, 20, 20, 10, 20], 0), ([10, 20, 21, 10, 15], 0.1),
+                 ([10, 20, 19, 21, 10, 15], 0.1), ([10, 20, 19, 18, 21, 20, 11, 10, 11, 15], 0.1),
+                 ([20, 10, 20], 0), ([19, 20, 10, 15], 0.1), ([20, 19, 30, 20], 0.1), ([20, 19, 20, 21, 30], 0.1)]
+        for prices, tolerance in cases:
+            signals = label_trades(prices, tolerance)
+            self.assertEqual(signals_to_trades(signals), optimize_trades(prices, tolerance))
+
+    def test_sweep(self):
+        random = np.random.RandomState(0)
+        prices = 50 * np.exp(np.cumsum(random.normal(0, 0.02, (3, 300)), axis=1))
+        tolerances = [0, 0.01, 0.05, 0.2]
+        signals = label_trades(prices, tolerances)
+        self.assertEqual(signals.shape, (3, 4, 300))
+        lanes = scan_trades(np.repeat(prices, 4, axis=0), np.tile(tolerances, 3))
+        self.assertTrue(np.array_equal(lanes.reshape(3, 4, 300), signals))
+        for i, row in enumerate(prices):
+            for j, tolerance in enumerate(tolerances):
+                trades = optimize_trades(row.tolist(), tolerance)
+                self.assertEqual(signals_to_trades(signals[i, j]), trades)
+                labels = smooth_labels(row, signals[i, j])
+                smoothed = smooth_trades(dict(trades), row.tolist())
+                self.assertEqual({k: v for k, v in enumerate(labels.tolist()) if v == v}, smoothed)
+
+    def test_padded(self):
+        prices = np.array([[10, 20, 19, 30, 10, 15], [10, 20, 10, np.nan, np.nan, np.nan]])
+        signals = label_trades(prices, 0)
+        self.assertEqual(signals_to_trades(signals[1]), optimize_trades([10, 20, 10], 0))
+        self.assertTrue(np.array_equal(scan_trades(prices, np.zeros(2)), signals))
+
+    def test_calc_trades_sweep(self):
+        data = {"2018-01-01": 20, "2018-01-02": 19, "2018-01-03": 30, "2018-01-04": 20}
+        sweep = calc_trades_sweep(data, [0, 0.1])
+        self.assertEqual(sweep[0.1], calc_trades(data, 0.1))
+        self.assertEqual(sweep[0], calc_trades(data, 0))
+
+
+def remove_last_row(path):
+    manifest = read_manifest(path)
+    manifest['length'] -= 1
+    write_manifest(path, manifest)
 
 
 def remove_folder(path):
@@ -118,6 +178,1077 @@ def remove_folder(path):
         pass
 
 
+class StandInData(Data):
+
+    def get_folder(self):
+        return 'stand_in'
+
+    def read_data(self):
+        return read_pickle(self.get_path('data.pkl'))
+
+    def write_data(self):
+        write_pickle(self.get_path('data.pkl'), self.get_data())
+
+    def get_new_data(self):
+        return {'value': self.params['value']}
+
+
+class TestScreen(unittest.TestCase):
+
+    def setUp(self):
+        nan = np.nan
+        # days x symbols x [close, SMA]
+        self.index = np.arange(4, dtype=np.int32) + date_to_day('2018-01-01')
+        self.values = np.array([
+            [[10, 9], [5, 6], [nan, nan]],
+            [[11, 10], [nan, nan], [nan, nan]],
+            [[12, 13], [6, 5], [nan, nan]],
+            [[nan, nan], [7, 5], [nan, nan]]
+        ], dtype=np.float32)
+
+    def test_latest_values(self):
+        latest = screen.get_latest_values(self.index, self.values, None, 5)
+        self.assertEqual(latest[:2].tolist(), [[12, 13], [7, 5]])
+        self.assertTrue(np.isnan(latest[2]).all())
+        latest = screen.get_latest_values(self.index, self.values, '2018-01-02', 1)
+        self.assertEqual(latest[0].tolist(), [11, 10])
+        self.assertTrue(np.isnan(latest[1]).all())
+
+    def test_conditions(self):
+        latest = screen.get_latest_values(self.index, self.values, None, 5)
+        columns = {'close': 0, 'SMA': 1}
+        keep = screen.apply_conditions([['close', '>', 'SMA']], lambda field: latest[:, columns[field]], 3)
+        self.assertEqual(keep.tolist(), [False, True, False])
+        keep = screen.apply_conditions([['close', '>=', 7], ['SMA', '<', 13]], lambda field: latest[:, columns[field]], 3)
+        self.assertEqual(keep.tolist(), [False, True, False])
+
+    def test_fields(self):
+        self.assertEqual(screen.get_field('close')[1], 'close')
+        self.assertEqual(screen.get_field('sma(50):SMA')[0]['time_period'], '50')
+        with self.assertRaises(Exception):
+            screen.get_field('pricetoearnings')
+
+
+class TestScreenerCache(unittest.TestCase):
+
+    def setUp(self):
+        self.data_folder = PARAMS['data_folder']
+        self.ttl = PARAMS['screener_ttl']
+        self.yahoo = screener.yahoo
+        PARAMS['data_folder'] = tempfile.mkdtemp()
+        self.fetches = []
+        screener.yahoo = lambda name: self.fetches.append(name) or ['AAPL', 'MSFT']
+
+    def tearDown(self):
+        screener.yahoo = self.yahoo
+        remove_folder(PARAMS['data_folder'])
+        PARAMS['data_folder'] = self.data_folder
+        PARAMS['screener_ttl'] = self.ttl
+
+    def test_reused(self):
+        PARAMS['screener_ttl'] = 60
+        self.assertEqual(get_symbols(None, 'day_gainers', None), ['AAPL', 'MSFT'])
+        self.assertEqual(get_symbols(['IBM'], 'day_gainers', 2), ['IBM', 'AAPL'])
+        self.assertEqual(self.fetches, ['day_gainers'])
+
+    def test_expired(self):
+        PARAMS['screener_ttl'] = 0
+        get_symbols(None, 'day_gainers', None)
+        get_symbols(None, 'day_gainers', None)
+        self.assertEqual(self.fetches, ['day_gainers', 'day_gainers'])
+
+    def test_snapshot(self):
+        path = os.path.join(screener.get_screener_folder('day_losers'), '2018-01-02.json')
+        screener.write_snapshot(path, ['GE'])
+        self.assertEqual(get_symbols(None, 'day_losers@2018-01-02', None), ['GE'])
+        with self.assertRaises(Exception):
+            get_symbols(None, 'day_losers@2018-01-03', None)
+        self.assertEqual(self.fetches, [])
+
+
+class TestServe(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'serve.sock')
+        self.serve = dict(PARAMS['serve'])
+        PARAMS['serve']['batch_wait'] = 0.05
+        self.loads = []
+        self.batches = []
+        self.server = serve.PredictServer(self.path, serve.ModelCache(1, load=self.load))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        PARAMS['serve'] = self.serve
+        remove_folder(self.folder)
+
+    def load(self, path):
+        self.loads.append(path)
+        sign = -1 if path == 'negative' else 1
+        return lambda matrix: self.batches.append(len(matrix)) or sign * matrix.sum(axis=1)
+
+    def test_predict(self):
+        self.assertEqual(serve.predict('positive', [[1, 2], [3, 4]], self.path), [3, 7])
+        self.assertEqual(serve.predict('negative', [[1, 2]], self.path), [-3])
+        self.assertEqual(serve.predict('positive', [[5, 5]], self.path), [10])
+        self.assertEqual(self.loads, ['positive', 'negative', 'positive'])
+
+    def test_batching(self):
+        results = download.map_concurrently(lambda i: serve.predict('positive', [[i, i]], self.path), range(16))
+        self.assertEqual(results, [[2 * i] for i in range(16)])
+        self.assertLess(len(self.batches), 16)
+        self.assertEqual(sum(self.batches), 16)
+
+    def test_error(self):
+        with self.assertRaises(Exception):
+            serve.predict('positive', [1, 2], self.path)
+        self.assertEqual(serve.predict('positive', [[1, 1]], self.path), [2])
+
+    def test_evicted(self):
+        models = serve.ModelCache(1, load=self.load)
+        batcher = models.get('positive')
+        models.get('negative')
+        with self.assertRaises(serve.ClosedException):
+            batcher.submit([[1, 2]])
+        self.assertEqual(models.submit('positive', [[1, 2]]).result(timeout=5), [3])
+        models.clear()
+
+    def test_slow_load(self):
+        started, loaded = threading.Event(), threading.Event()
+        def load(path):
+            if path == 'slow':
+                started.set()
+                loaded.wait(5)
+            return self.load(path)
+        models = serve.ModelCache(2, load=load)
+        slow = [threading.Thread(target=models.get, args=('slow',)) for _ in range(2)]
+        [thread.start() for thread in slow]
+        started.wait(5)
+        self.assertEqual(models.submit('positive', [[1, 2]]).result(timeout=1), [3])
+        loaded.set()
+        [thread.join() for thread in slow]
+        self.assertEqual(self.loads, ['positive', 'slow'])
+        models.clear()
+
+
+class TestTrain(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+
+    def get_part(self, rows, seed):
+        values = np.random.RandomState(seed).uniform(-1, 1, (rows, 3))
+        out = 0.5 * np.tanh(values[:, 0] - values[:, 1])
+        return preprocess.WindowedPart(values, np.arange(rows), out, 0, ['a', 'b', 'c'])
+
+    def test_gradients(self):
+        network = train.Network.create(3, 4, seed=0)
+        matrix = np.random.RandomState(1).uniform(-1, 1, (5, 3))
+        truth = np.linspace(-0.5, 0.5, 5)
+        _, gradients = network.get_gradients(matrix, truth, 'mean_squared_error')
+        get_loss = train.LOSSES['mean_squared_error'][0]
+        for key, weights in network.weights.items():
+            weights.flat[0] += 1e-6
+            loss_up = get_loss(network.predict(matrix), truth)
+            weights.flat[0] -= 2e-6
+            loss_down = get_loss(network.predict(matrix), truth)
+            weights.flat[0] += 1e-6
+            self.assertAlmostEqual(gradients[key].flat[0], (loss_up - loss_down) / 2e-6, places=5)
+
+    def test_train(self):
+        parts = {'training': self.get_part(512, 0), 'validation': self.get_part(128, 1),
+                 'evaluation': self.get_part(64, 2)}
+        network, data = train.train(parts, 3, 10, 16, 'tanh', 'mean_squared_error', 32)
+        self.assertEqual(len(data['training_loss']), 10)
+        self.assertLess(data['validation_loss'][-1], data['validation_loss'][0] / 2)
+        self.assertEqual(data['output']['result']['out'].shape, (64,))
+        self.assertEqual(data['output']['truth']['out'].tolist(), parts['evaluation'].out.tolist())
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, 'weights.npz')
+        network.save(path)
+        matrix = parts['evaluation'].materialize()[0]
+        self.assertEqual(train.Network.load(path).predict(matrix).tolist(), network.predict(matrix).tolist())
+        remove_folder(folder)
+
+    def test_resume(self):
+        parts = {'training': self.get_part(256, 0), 'validation': self.get_part(64, 1),
+                 'evaluation': self.get_part(64, 2)}
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, 'checkpoint.pkl')
+        _, first = train.train(parts, 3, 2, 8, 'tanh', 'mean_squared_error', 32, path)
+        _, data = train.train(parts, 3, 4, 8, 'tanh', 'mean_squared_error', 32, path)
+        self.assertEqual(data['training_loss'][:2].tolist(), first['training_loss'].tolist())
+        self.assertEqual(len(data['training_loss']), 4)
+        remove_folder(folder)
+
+    # training moves the predictions away from the validation labels
+    def test_early_stopping(self):
+        training = self.get_part(256, 0)
+        training.out = np.full(256, 0.9)
+        validation = self.get_part(64, 1)
+        validation.out = np.zeros(64)
+        parts = {'training': training, 'validation': validation, 'evaluation': validation}
+        network, data = train.train(parts, 3, 20, 8, 'tanh', 'mean_squared_error', 32, patience=2)
+        best = int(np.argmin(data['validation_loss']))
+        self.assertLess(best + 3, 20)
+        self.assertEqual(len(data['validation_loss']), best + 3)
+        self.assertAlmostEqual(np.mean((data['output']['result']['out'] - validation.out) ** 2),
+                               data['validation_loss'][best])
+
+
+class TestData(unittest.TestCase):
+
+    def setUp(self):
+        self.data_folder = PARAMS['data_folder']
+        PARAMS['data_folder'] = tempfile.mkdtemp()
+
+    def tearDown(self):
+        remove_folder(PARAMS['data_folder'])
+        PARAMS['data_folder'] = self.data_folder
+
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint({'a': 1, 'b': [1, 2]}), fingerprint({'b': [1, 2], 'a': 1}))
+        self.assertNotEqual(fingerprint({'a': 1}), fingerprint({'a': 2}))
+        path = StandInData(value=1).get_path()
+        self.assertEqual(os.path.basename(path), fingerprint({'value': 1}))
+        self.assertEqual(read_pickle(os.path.join(path, 'params.pkl')), {'value': 1})
+
+    def test_params_written_once(self):
+        params_path = StandInData(value=1).get_params_path()
+        os.utime(params_path, (0, 0))
+        StandInData(value=1)
+        self.assertEqual(os.stat(params_path).st_mtime, 0)
+
+    def test_migrate_legacy_folder(self):
+        legacy_path = os.path.join(PARAMS['data_folder'], 'stand_in', get_legacy_name({'value': 2}))
+        make_path(os.path.join(legacy_path, 'data.pkl'))
+        write_pickle(os.path.join(legacy_path, 'data.pkl'), {'value': 'cached'})
+        data = StandInData(value=2)
+        self.assertEqual(data.get_data(), {'value': 'cached'})
+        self.assertFalse(os.path.exists(legacy_path))
+
+    def test_network_train_params(self):
+        part = {'symbols': ['A'], 'start': None, 'end': None}
+        params = {'training': part, 'validation': part, 'evaluation': part, 'options_list': []}
+        network = StandInNetwork(**params)
+        self.assertEqual((network.params['patience'], network.params['batch_size']),
+                         (PARAMS['train']['patience'], PARAMS['train']['batch_size']))
+        self.assertNotEqual(StandInNetwork(**params, patience=1).get_path(),
+                            StandInNetwork(**params, patience=2).get_path())
+        legacy_path = get_data_path('neural', {**params, 'epochs': 3})
+        make_path(os.path.join(legacy_path, 'data.pkl'))
+        write_pickle(os.path.join(legacy_path, 'data.pkl'), {'accuracy': 0})
+        self.assertEqual(StandInNetwork(**params, epochs=3).get_path(), legacy_path)
+
+    # neural.py passes only the train params given, and ones with the values
+    # networks had before still find their folders
+    def test_network_train_args(self):
+        part = {'symbols': ['A'], 'start': None, 'end': None}
+        params = {'training': part, 'validation': part, 'evaluation': part, 'options_list': [], 'epochs': 3}
+        legacy_path = get_data_path('neural', params)
+        make_path(os.path.join(legacy_path, 'data.pkl'))
+        write_pickle(os.path.join(legacy_path, 'data.pkl'), {'accuracy': 0})
+        parser = ArgumentParser()
+        neural.add_args(parser)
+        for args, path in [([], legacy_path), (['-b', '32', '--patience', '5'], legacy_path),
+                           (['-b', '64'], get_data_path('neural', {**params, 'batch_size': 64, 'patience': 5}))]:
+            train_params = neural.get_train_params(parser.parse_args(['-s', 'A', '-o', '0'] + args))
+            self.assertEqual(StandInNetwork(**params, **train_params).get_path(), path)
+
+
+class TestSchema(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'schema.jsonl')
+
+    def tearDown(self):
+        remove_folder(self.folder)
+
+    def test_ids(self):
+        schema = Schema(self.path)
+        options = {'function': 'SMA', 'columns': ['SMA'], 'time_period': 20}
+        self.assertEqual(schema.get_id(options, 'SMA'), 0)
+        self.assertEqual(schema.get_id({**options, 'time_period': 10}, 'SMA'), 1)
+        self.assertEqual(schema.get_id(dict(reversed(list(options.items()))), 'SMA'), 0)
+        self.assertEqual(schema.get_options(1), {**options, 'time_period': 10, 'column': 'SMA'})
+
+    def test_shared_file(self):
+        first = Schema(self.path)
+        second = Schema(self.path)
+        self.assertEqual(first.get_id({'a': 1}, 'x'), 0)
+        self.assertEqual(second.get_id({'a': 2}, 'x'), 1)
+        self.assertEqual(first.get_id({'a': 2}, 'x'), 1)
+        self.assertEqual(second.get_options(0), {'a': 1, 'column': 'x'})
+        self.assertEqual(Schema(self.path).keys, first.keys)
+
+
+class TestSymbolFrame(unittest.TestCase):
+
+    def setUp(self):
+        self.data = {
+            '2018-01-02': {'a': '1', 'b': '2'},
+            '2018-01-03': {'a': '3', 'b': ''},
+            '2018-01-04': {'a': '5', 'b': '6'},
+            '2018-01-05': {'a': '7', 'b': '8'}
+        }
+        self.frame = SymbolFrame.from_dict(self.data)
+
+    def test_dict(self):
+        self.assertEqual(self.frame.get_dates(), sorted(self.data))
+        self.assertEqual(self.frame.to_dict(), {
+            date: {column: float(value) if value else '' for column, value in datum.items()}
+            for date, datum in self.data.items()
+        })
+
+    def test_dates_to_days(self):
+        dates = ['1969-12-31', '2000-02-29', '2018-01-02']
+        self.assertEqual(dates_to_days(dates).tolist(), [date_to_day(date) for date in dates])
+
+    def test_slice(self):
+        frame = self.frame.slice('2018-01-03', '2018-01-04')
+        self.assertEqual(frame.get_dates(), ['2018-01-03', '2018-01-04'])
+        self.assertEqual(frame.get_series('a').tolist(), [3, 5])
+        self.assertIs(self.frame.slice(None, None), self.frame)
+
+    def test_dropna(self):
+        frame = self.frame.dropna()
+        self.assertEqual(frame.to_dict(), filter_incomplete(self.frame.to_dict()))
+        self.assertEqual(frame.get_matrix(['b', 'a']).tolist(), [[2, 1], [6, 5], [8, 7]])
+
+    def test_join(self):
+        labels = SymbolFrame.from_series({'2018-01-01': 0, '2018-01-03': 1, '2018-01-05': -1}, 'label')
+        frame, labels = self.frame.join(labels)
+        self.assertEqual(frame.get_dates(), ['2018-01-03', '2018-01-05'])
+        self.assertEqual(labels.get_dates(), frame.get_dates())
+        self.assertEqual(labels.get_series('label').tolist(), [1, -1])
+
+    def test_calc_trades(self):
+        prices = {'2018-01-01': 20, '2018-01-02': 19, '2018-01-03': 30, '2018-01-04': 20}
+        frame = SymbolFrame.from_series(prices, 'close')
+        self.assertEqual(calc_trades(frame, 0.1), calc_trades(prices, 0.1))
+
+
+class TestStore(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        remove_folder(self.folder)
+
+    def test_round_trip(self):
+        data = {'2018-01-02': {'a': '1.5', 'b': '2'}, '2018-01-03': {'a': '3', 'b': ''}}
+        merge_store(self.folder, data)
+        index, columns = read_store(self.folder)
+        self.assertEqual(store_to_dict(index, columns),
+                         {'2018-01-02': {'a': 1.5, 'b': 2.0}, '2018-01-03': {'a': 3.0, 'b': ''}})
+
+    def test_append(self):
+        merge_store(self.folder, {'2018-01-02': {'a': '1'}})
+        merge_store(self.folder, {'2018-01-03': {'a': '2'}, '2018-01-04': {'a': '3'}})
+        index, columns = read_store(self.folder)
+        self.assertEqual([day_to_date(d) for d in index], ['2018-01-02', '2018-01-03', '2018-01-04'])
+        self.assertEqual(columns['a'].tolist(), [1, 2, 3])
+
+    def test_truncated_append(self):
+        merge_store(self.folder, {'2018-01-02': {'a': '1'}, '2018-01-03': {'a': '2'}})
+        remove_last_row(self.folder)
+        merge_store(self.folder, {'2018-01-03': {'a': '4'}})
+        index, columns = read_store(self.folder)
+        self.assertEqual(len(index), 2)
+        self.assertEqual(columns['a'].tolist(), [1, 4])
+
+    def test_new_column(self):
+        merge_store(self.folder, {'2018-01-02': {'a': '1'}, '2018-01-03': {'a': '2'}})
+        merge_store(self.folder, {'2018-01-03': {'a': '5', 'b': '6'}})
+        index, columns = read_store(self.folder)
+        self.assertEqual(columns['a'].tolist(), [1, 5])
+        self.assertTrue(np.isnan(columns['b'][0]))
+        self.assertEqual(columns['b'][1], 6)
+
+    def test_insert_before_last(self):
+        merge_store(self.folder, {'2018-01-02': {'a': '1'}, '2018-01-04': {'a': '3'}})
+        merge_store(self.folder, {'2018-01-03': {'a': '2'}})
+        index, columns = read_store(self.folder)
+        self.assertEqual(columns['a'].tolist(), [1, 2, 3])
+
+    def test_slice(self):
+        merge_store(self.folder, {'2018-01-0%s' % d: {'a': d} for d in range(1, 8)})
+        index, columns = slice_store(*read_store(self.folder), '2018-01-03', '2018-01-05')
+        self.assertEqual(columns['a'].tolist(), [3, 4, 5])
+
+
+def make_prices(close, spread=1):
+    close = np.array(close, dtype=float)
+    return {'open': close, 'high': close + spread, 'low': close - spread, 'close': close,
+            'volume': np.full(len(close), 100.0)}
+
+
+def assert_nan_equal(test, actual, expected):
+    np.testing.assert_allclose(actual, np.array(expected, dtype=float))
+
+
+class TestStoreCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = StoreCache(10 ** 6)
+
+    def tearDown(self):
+        remove_folder(self.folder)
+
+    def get_store(self, name, rows=10):
+        folder = os.path.join(self.folder, name)
+        write_store(folder, np.arange(rows, dtype=np.int32), {'a': np.arange(rows, dtype=float)})
+        return folder
+
+    def test_hits(self):
+        folder = self.get_store('A')
+        index, columns = self.cache.get(folder)
+        self.assertIs(self.cache.get(folder)[1]['a'], columns['a'])
+        self.assertFalse(columns['a'].flags.writeable)
+        self.assertEqual(self.cache.get_stats(), {'hits': 1, 'misses': 1, 'stores': 1, 'bytes': 120})
+
+    def test_reload_changed(self):
+        folder = self.get_store('A')
+        self.cache.get(folder)
+        merge_store(folder, {day_to_date(3): {'a': 30}})
+        self.assertEqual(self.cache.get(folder)[1]['a'][3], 30)
+        self.assertEqual(self.cache.get_stats()['misses'], 2)
+
+    def test_evict(self):
+        self.cache.max_bytes = 250
+        folders = [self.get_store(name) for name in 'ABC']
+        for folder in folders:
+            self.cache.get(folder)
+        self.cache.get(folders[1])
+        self.assertEqual(list(self.cache.entries), [folders[2], folders[1]])
+        self.assertEqual(self.cache.get_stats()['bytes'], 240)
+
+    def test_missing(self):
+        index, columns = self.cache.get(os.path.join(self.folder, 'missing'))
+        self.assertEqual((len(index), columns), (0, {}))
+
+
+class TestTechnical(unittest.TestCase):
+
+    def test_sma(self):
+        data = technical.sma(make_prices([1, 2, 3, 4, 5]), indicators.sma(3))
+        assert_nan_equal(self, data['SMA'], [np.nan, np.nan, 2, 3, 4])
+
+    def test_ema(self):
+        data = technical.ema(make_prices([1, 2, 3, 4, 6]), indicators.ema(3))
+        assert_nan_equal(self, data['EMA'], [np.nan, np.nan, 2, 3, 4.5])
+
+    def test_rsi(self):
+        data = technical.rsi(make_prices([1, 2, 1, 2, 3]), indicators.rsi(2))
+        assert_nan_equal(self, data['RSI'], [np.nan, np.nan, 50, 75, 87.5])
+
+    def test_macd(self):
+        data = technical.macd(make_prices(list(range(1, 11))), indicators.macd(2, 3, 2))
+        assert_nan_equal(self, data['MACD'], [np.nan] * 3 + [0.5] * 7)
+        assert_nan_equal(self, data['MACD_Hist'], [np.nan] * 3 + [0] * 7)
+
+    def test_bbands(self):
+        data = technical.bbands(make_prices([2, 2, 2, 4]), indicators.bbands(2))
+        assert_nan_equal(self, data['Real Middle Band'], [np.nan, 2, 2, 3])
+        assert_nan_equal(self, data['Real Upper Band'], [np.nan, 2, 2, 5])
+
+    def test_aroon(self):
+        data = technical.aroon(make_prices([1, 3, 2, 1]), indicators.aroon(2))
+        assert_nan_equal(self, data['Aroon Up'], [np.nan, np.nan, 50, 0])
+        assert_nan_equal(self, data['Aroon Down'], [np.nan, np.nan, 0, 100])
+
+    def test_obv(self):
+        data = technical.obv(make_prices([1, 2, 2, 1]), indicators.obv())
+        assert_nan_equal(self, data['OBV'], [100, 200, 200, 100])
+
+    def test_stoch(self):
+        data = technical.stoch(make_prices([1, 2, 3, 4, 5]), indicators.stoch(2, 1, 1))
+        assert_nan_equal(self, data['SlowK'], [np.nan, 2 / 3 * 100, 2 / 3 * 100, 2 / 3 * 100, 2 / 3 * 100])
+
+    def test_adx_trend(self):
+        data = technical.adx(make_prices(list(range(1, 30))), indicators.adx(5))
+        self.assertTrue(np.isnan(data['ADX'][8]))
+        assert_nan_equal(self, data['ADX'][9:], [100] * 20)
+
+
+class TestRefresh(unittest.TestCase):
+
+    def setUp(self):
+        data = {'2018-01-02': {'a': '1', 'b': '2'}, '2018-01-03': {'a': '3', 'b': ''}}
+        self.index, self.columns = dict_to_arrays(data)
+
+    def test_overlap(self):
+        data = {'2018-01-03': {'a': '3', 'b': '5'}, '2018-01-04': {'a': '4', 'b': '6'}}
+        self.assertTrue(verify_overlap(self.index, self.columns, data, '2018-01-03'))
+
+    def test_overlap_changed(self):
+        data = {'2018-01-03': {'a': '3.5'}, '2018-01-04': {'a': '4'}}
+        self.assertFalse(verify_overlap(self.index, self.columns, data, '2018-01-03'))
+
+    def test_overlap_gap(self):
+        data = {'2018-01-04': {'a': '4'}}
+        self.assertFalse(verify_overlap(self.index, self.columns, data, '2018-01-03'))
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    delay = 0
+    requests = []
+    dates = ['2018-01-02', '2018-01-03']
+    throttled = 0
+
+    def do_GET(self):
+        query = dict(parse_qsl(urlparse(self.path).query))
+        StandInHandler.requests.append(query)
+        time.sleep(self.delay)
+        if StandInHandler.throttled:
+            StandInHandler.throttled -= 1
+            return self.send_json({'Note': 'Thank you for using Alpha Vantage!'})
+        row = {'1. open': '1', '2. high': '2', '3. low': '0.5', '4. close': '1.5', '5. volume': '100',
+               'SMA': '1.25', 'EMA': '1.3'}
+        self.send_json({'Meta Data': {}, query['function']: {date: row for date in StandInHandler.dates}})
+
+    def send_json(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInNetwork(NeuralNetwork):
+
+    def get_new_data(self):
+        return {'accuracy': 1}
+
+    def load_model(self):
+        return self
+
+    # predicts each row's sum
+    def predict(self, matrix):
+        self.batches = getattr(self, 'batches', []) + [len(matrix)]
+        return matrix.sum(axis=1)
+
+
+class TestDownload(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StandInServer(('127.0.0.1', 0), StandInHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = PARAMS['alphavantage_url']
+        cls.download = dict(PARAMS['download'])
+        cls.client = dict(PARAMS['client'])
+        cls.data_folder = PARAMS['data_folder']
+        PARAMS['alphavantage_url'] = 'http://127.0.0.1:%s/query' % cls.server.server_port
+        PARAMS['data_folder'] = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        PARAMS['alphavantage_url'] = cls.url
+        PARAMS['download'] = cls.download
+        PARAMS['client'] = cls.client
+        remove_folder(PARAMS['data_folder'])
+        PARAMS['data_folder'] = cls.data_folder
+        download.reset()
+        client.reset()
+
+    def setUp(self):
+        StandInHandler.delay = 0
+        StandInHandler.requests = []
+        StandInHandler.dates = ['2018-01-02', '2018-01-03']
+        StandInHandler.throttled = 0
+        PARAMS['download'] = {'workers': 4, 'requests_per_minute': 60000, 'burst': 1, 'daily_quota': 500}
+        PARAMS['client'] = {'timeout': 5, 'retries': 2, 'backoff': 0.01, 'max_backoff': 0.05}
+        download.reset()
+        client.reset()
+
+    def test_download(self):
+        data = download_symbol_data('AAPL', get_options_list(['daily', 'sma']))
+        self.assertEqual(sorted(data), ['2018-01-02', '2018-01-03'])
+        self.assertEqual(len(data['2018-01-02']), 6)
+        self.assertEqual(sorted(r['function'] for r in StandInHandler.requests), ['SMA', 'TIME_SERIES_DAILY'])
+
+    def test_concurrent(self):
+        StandInHandler.delay = 0.2
+        start = time.monotonic()
+        download.map_concurrently(lambda s: download_symbol_data(s, get_options_list(['sma', 'ema'])), 'ABCD')
+        self.assertLess(time.monotonic() - start, 8 * 0.2 / 2)
+        self.assertEqual(len(StandInHandler.requests), 8)
+
+    def test_rate_limit(self):
+        PARAMS['download']['requests_per_minute'] = 600
+        download.reset()
+        start = time.monotonic()
+        download_symbol_data('AAPL', get_options_list(['sma', 'ema', 'sma(10)', 'ema(10)', 'sma(20)', 'ema(30)']))
+        self.assertGreaterEqual(time.monotonic() - start, 0.5)
+
+    def test_incremental_refresh(self):
+        latest = date_to_day(get_latest_weekday())
+        StandInHandler.dates = [day_to_date(latest - i) for i in range(7)]
+        data = SymbolData(symbol='AAPL', options_list=get_options_list(['daily']))
+        remove_last_row(data.get_symbol_path())
+        remove_last_row(data.get_symbol_path())
+        StandInHandler.requests = []
+        data = SymbolData(symbol='AAPL', options_list=get_options_list(['daily']))
+        data.refresh_data(update_old=True)
+        self.assertEqual([r.get('outputsize') for r in StandInHandler.requests], ['compact'])
+        self.assertEqual(len(data.index), 7)
+
+    def test_frames(self):
+        data = SymbolData(symbol='IBM', options_list=get_options_list(['daily', 'sma']))
+        self.assertEqual(data.get_frame().to_dict(), data.get_data())
+        close = SymbolCloseData(symbol='IBM')
+        self.assertEqual(close.get_frame().to_series('close'), close.get_data())
+
+    def test_panel(self):
+        latest = date_to_day(get_latest_weekday())
+        StandInHandler.dates = [day_to_date(latest - i) for i in range(1, 6)]
+        panel = Panel(symbols=['PNLA', 'PNLB'], options_list=get_options_list(['daily']))
+        self.assertEqual(panel.get_values().shape, (2, 5, 5))
+        self.assertIsInstance(panel.values, np.memmap)
+        StandInHandler.dates = [day_to_date(latest - i) for i in range(6)]
+        inode = os.stat(panel.get_path('values.f4')).st_ino
+        panel.update(refresh=True)
+        self.assertEqual(panel.get_values().shape, (2, 6, 5))
+        self.assertEqual(os.stat(panel.get_path('values.f4')).st_ino, inode)
+        self.assertTrue(panel.get_mask().all())
+        self.assertEqual(panel.get_dates()[-1], get_latest_weekday())
+        frame = SymbolData(symbol='PNLA', options_list=get_options_list(['daily'])).get_frame()
+        self.assertEqual(panel.get_frame('PNLA').get_matrix().tolist(), frame.get_matrix().tolist())
+        index, values = panel.slice(day_to_date(latest - 1), day_to_date(latest))
+        self.assertEqual((len(index), values.shape), (2, (2, 2, 5)))
+
+    def test_panel_refreshed_apart(self):
+        StandInHandler.dates = ['2018-01-02', '2018-01-03', '2018-01-04']
+        SymbolData(symbol='PRFA', options_list=get_options_list(['daily']))
+        StandInHandler.dates = ['2018-01-02', '2018-01-03']
+        data = SymbolData(symbol='PRFB', options_list=get_options_list(['daily']))
+        panel = Panel(symbols=['PRFA', 'PRFB'], options_list=get_options_list(['daily']))
+        self.assertTrue(np.isnan(panel.get_values()[1, 2]).all())
+        StandInHandler.dates = ['2018-01-03', '2018-01-04']
+        data.download_data([DAILY_OPTIONS])
+        panel.update()
+        self.assertTrue(panel.get_mask().all())
+        merge_store(data.get_symbol_path(), {'2018-01-03': {get_close_id(): '2'}})
+        panel.update()
+        close = panel.data['columns'].index(get_close_id())
+        self.assertEqual(panel.get_values()[:, :, close].tolist(), [[1.5, 1.5, 1.5], [1.5, 2, 1.5]])
+        panel = Panel(symbols=['PRFA', 'PRFB'], options_list=get_options_list(['daily']))
+        self.assertEqual(panel.get_values()[1, :, close].tolist(), [1.5, 2, 1.5])
+
+    def test_screen(self):
+        StandInHandler.dates = ['2018-01-02', '2018-01-03']
+        symbols = ['SCRA', 'SCRB']
+        for symbol in symbols:
+            SymbolData(symbol=symbol, options_list=get_options_list(['daily']))
+        self.assertEqual(screen.get_cached_symbols()[-2:], symbols)
+        self.assertEqual(screen.screen([['close', '>', 'open']], symbols), symbols)
+        self.assertEqual(screen.screen([['close', '>', 'high']], symbols), [])
+        self.assertEqual(screen.screen([['volume', '=', 100], ['low', '<', 1]], symbols), symbols)
+
+    def test_screen_cached(self):
+        StandInHandler.dates = [get_latest_weekday()]
+        SymbolData(symbol='SCCA', options_list=get_options_list(['daily']))
+        StandInHandler.requests = []
+        self.assertIn('SCCA', screen.screen([['close', '>', 'open']], update=True))
+        self.assertNotIn('SCCA', screen.screen([['close', '>', 'SMA']], update=True))
+        self.assertEqual(StandInHandler.requests, [])
+        path = Panel(symbols=None, options_list=get_options_list(['daily']), cached=True).get_path()
+        SymbolData(symbol='SCCB', options_list=get_options_list(['daily']))
+        self.assertNotIn('SCCB', screen.screen([['close', '>', 'open']]))
+        self.assertIn('SCCB', screen.screen([['close', '>', 'open']], update=True))
+        panel = Panel(symbols=None, options_list=get_options_list(['daily']), cached=True)
+        self.assertEqual(panel.get_path(), path)
+
+    def test_migrate_column_names(self):
+        data = SymbolData(symbol='MSFT', options_list=get_options_list(['daily']))
+        path = data.get_symbol_path()
+        manifest = read_manifest(path)
+        manifest['columns'] = [[encrypt_dict(get_schema().get_options(column)), file_name]
+                               for column, file_name in manifest['columns']]
+        write_manifest(path, manifest)
+        symbol.MIGRATED.discard(path)
+        StandInHandler.requests = []
+        data = SymbolData(symbol='MSFT', options_list=get_options_list(['daily']))
+        self.assertEqual(StandInHandler.requests, [])
+        self.assertEqual(sorted(data.columns), sorted(column_id for _, column_id in get_column_ids(DAILY_OPTIONS)))
+
+    def test_throttled(self):
+        StandInHandler.throttled = 2
+        data = download_symbol_data('AAPL', get_options_list(['sma']))
+        self.assertEqual(sorted(data), ['2018-01-02', '2018-01-03'])
+        stats = client.get_stats()['alphavantage']
+        self.assertEqual((stats['requests'], stats['retries'], stats['failures']), (3, 2, 0))
+        StandInHandler.throttled = 3
+        with self.assertRaises(client.ThrottledException):
+            download_symbol_data('AAPL', get_options_list(['sma']))
+        self.assertEqual(client.get_stats()['alphavantage']['failures'], 1)
+
+    def test_jobs(self):
+        if os.path.exists(jobs.get_jobs_path()):
+            os.remove(jobs.get_jobs_path())
+        PARAMS['download']['daily_quota'] = 1
+        self.assertEqual(jobs.add_jobs(['JOBA', 'JOBB'], get_options_list(['daily', 'sma'])), 4)
+        self.assertEqual(jobs.add_jobs(['JOBC'], get_options_list(['daily']), priority=jobs.NEEDED), 1)
+        self.assertEqual(jobs.run_jobs(), 1)
+        self.assertEqual([r['symbol'] for r in StandInHandler.requests], ['JOBC'])
+        PARAMS['download']['daily_quota'] = 3
+        self.assertEqual(jobs.run_jobs(['JOBB']), 2)
+        self.assertEqual([r['symbol'] for r in StandInHandler.requests], ['JOBC', 'JOBB', 'JOBB'])
+        self.assertEqual((jobs.get_quota_left(), jobs.run_jobs()), (0, 0))
+        PARAMS['download']['daily_quota'] = 10
+        self.assertEqual(jobs.run_jobs(), 2)
+        self.assertEqual((jobs.get_jobs(), jobs.get_quota_left()), ([], 5))
+        self.assertEqual(jobs.add_jobs(['JOBA', 'JOBB'], get_options_list(['daily', 'sma'])), 0)
+
+    def test_jobs_quota_per_request(self):
+        if os.path.exists(jobs.get_jobs_path()):
+            os.remove(jobs.get_jobs_path())
+        PARAMS['download']['daily_quota'] = 2
+        StandInHandler.throttled = 5
+        jobs.add_jobs(['JOBQ'], get_options_list(['daily']))
+        self.assertEqual(jobs.run_jobs(), 0)
+        self.assertEqual((len(StandInHandler.requests), jobs.get_quota_left()), (2, 0))
+        self.assertEqual([job['failures'] for job in jobs.get_jobs()], [0])
+        self.assertEqual(client.QUOTAS, {})
+
+    def test_fetch_plan(self):
+        StandInHandler.dates = ['2018-01-02', '2018-01-03']
+        requests = [{'symbol': 'PLNA', 'options_list': get_options_list(['daily', 'sma'])},
+                    {'symbol': 'PLNB', 'options_list': get_options_list(['daily'])},
+                    {'symbol': 'PLNA', 'options_list': get_options_list(['sma', 'ema'])}]
+        plan = symbol.FetchPlan(requests)
+        self.assertEqual(plan.get_cost()['calls'], 4)
+        self.assertEqual(StandInHandler.requests, [])
+        data = plan.execute()
+        self.assertEqual(len(StandInHandler.requests), 4)
+        self.assertEqual([(d.symbol, d.options_list) for d in data],
+                         [(r['symbol'], r['options_list']) for r in requests])
+        self.assertEqual(len(StandInHandler.requests), 4)
+        self.assertEqual(symbol.FetchPlan(requests).get_calls(), [])
+        cost = symbol.FetchPlan(requests, refresh=True).get_cost()
+        self.assertEqual((cost['symbols'], cost['full'], cost['incremental']), (2, 0, 4))
+
+    def test_predict_table(self):
+        StandInHandler.dates = ['2018-01-02', '2018-01-03', '2018-01-04']
+        part = {'symbols': ['PRDA', 'PRDB'], 'start': None, 'end': None}
+        network = StandInNetwork(training=part, validation=part, evaluation=part,
+                                 options_list=get_options_list(['daily']), days=1)
+        pairs = [('PRDB', '2018-01-03'), ('PRDA', '2018-01-02'), ('PRDA', '2018-01-03'),
+                 ('PRDA', '2018-01-04'), ('PRDB', '2018-02-01')]
+        symbols, dates, table = network.predict_table(pairs, batch_size=2)
+        self.assertEqual(symbols, ['PRDA', 'PRDB'])
+        self.assertEqual(dates, ['2018-01-02', '2018-01-03', '2018-01-04', '2018-02-01'])
+        self.assertEqual(np.isnan(table).tolist(), [[True, False, False, True], [True, False, True, True]])
+        self.assertEqual(table[0, 1], 2 * 105.0)
+        self.assertEqual(network.batches, [2, 1])
+        self.assertEqual(network.predict_batch(np.ones((3, 4))).tolist(), [4, 4, 4])
+
+    # networks build their inputs in the order they were trained on, and ones
+    # train.py trained before it was kept are trained again
+    def test_network_inputs(self):
+        StandInHandler.dates = ['2018-01-02', '2018-01-03', '2018-01-04']
+        part = {'symbols': ['ORDA'], 'start': None, 'end': None}
+        options_list = get_options_list(['daily'])
+        network = StandInNetwork(training=part, validation=part, evaluation=part, options_list=options_list, days=1)
+        frame = SymbolData(symbol='ORDA', options_list=options_list).get_frame()
+        expected, _ = preprocess.get_symbol_inputs(frame, ['2018-01-03'], 1)
+        inputs = preprocess.get_input_order(preprocess.get_input_columns(options_list), 1)
+        network.data = {'inputs': inputs[::-1]}
+        matrix, found = network.get_inputs('ORDA', ['2018-01-03'])
+        self.assertEqual((matrix.tolist(), found), (expected[:, ::-1].tolist(), ['2018-01-03']))
+        write_pickle(network.get_data_path(), {'accuracy': 1})
+        write_pickle(network.get_weights_path(), {})
+        self.assertIsNone(network.read_data())
+
+    def test_live_inputs(self):
+        StandInHandler.dates = ['2018-01-02', '2018-01-03', '2018-01-04']
+        options_list = get_options_list(['daily', 'sma'])
+        frame = SymbolData(symbol='LIVA', options_list=options_list).get_frame()
+        folder = symbol.get_symbol_folder('LIVA')
+        append_store(folder, dates_to_days(['2018-01-05', '2018-01-08']).astype(INDEX_DTYPE), {})
+        rows = preprocess.LIVE_ROWS
+        preprocess.LIVE_ROWS = 0
+        try:
+            symbols, dates, matrix = preprocess.get_live_inputs(['LIVA', 'NONE'], options_list, 1)
+        finally:
+            preprocess.LIVE_ROWS = rows
+        self.assertEqual((symbols, dates), (['LIVA'], ['2018-01-04']))
+        expected, _ = preprocess.get_symbol_inputs(frame, ['2018-01-04'], 1)
+        self.assertEqual(matrix.tolist(), expected.tolist())
+
+    def test_session(self):
+        self.assertIs(client.get_session(), client.get_session())
+        session = client.get_session()
+        client.reset()
+        self.assertIsNot(client.get_session(), session)
+
+    def test_limiter(self):
+        limiter = download.RateLimiter(1200, burst=2)
+        start = time.monotonic()
+        [limiter.acquire() for _ in range(4)]
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
+
+def fake_symbol_part(symbol, options_list, start, end, days, tolerance):
+    if symbol == 'BAD':
+        raise DataException('No data for BAD')
+    if symbol == 'BUG':
+        raise TypeError('Not a data error')
+    rows = len(symbol)
+    return np.full((rows, 2), float(rows)), np.arange(rows, dtype=float)
+
+
+# the dict based builder lag_matrix replaced, kept to check the legacy inputs order
+def prior_days_reference(data, days, full_data):
+    new_data = {}
+    full_dates = sorted(full_data)
+    for date in sorted(data):
+        current = full_dates.index(date)
+        new_data[date] = {}
+        for prior in range(days + 1):
+            prior_data = full_data[full_dates[current - prior]]
+            for col in prior_data:
+                new_data[date][str(col) + str(prior)] = prior_data[col]
+    return new_data
+
+
+class TestLagMatrix(unittest.TestCase):
+
+    def setUp(self):
+        dates = ['2018-01-%02d' % day for day in range(1, 31)]
+        self.data = {
+            date: {column: float(i * 10 + j) for j, column in enumerate(['bx', 'a', 'b'])}
+            for i, date in enumerate(dates)
+        }
+
+    def check_days(self, days):
+        frame = SymbolFrame.from_dict(self.data)
+        columns = sorted(frame.get_columns())
+        values = frame.get_matrix(columns)
+        matched = frame.get_dates()[days::3]
+        positions = np.arange(len(frame))[days::3]
+        expected = json_to_matrix(prior_days_reference(matched, days, self.data))
+        inputs = preprocess.get_legacy_input_order(columns, days, columns)
+        actual = preprocess.lag_matrix(values, positions, days, columns, inputs)
+        self.assertEqual(actual.tolist(), expected.tolist())
+
+    def test_no_prior_days(self):
+        self.check_days(0)
+
+    def test_prior_days(self):
+        self.check_days(3)
+
+    # keys like b10 sort before b2 once days reaches 10
+    def test_two_digit_prior_days(self):
+        self.check_days(12)
+
+    def test_no_positions(self):
+        frame = SymbolFrame.from_dict(self.data)
+        self.assertEqual(preprocess.lag_matrix(frame.get_matrix(), [], 2, frame.get_columns()).shape, (0, 9))
+
+    # column ids 1 and 11 both have the key 110 at priors 10 and 0
+    def test_input_order(self):
+        inputs = preprocess.get_input_order([11, 1], 10)
+        self.assertEqual(inputs, [(1, prior) for prior in range(11)] + [(11, prior) for prior in range(11)])
+        values = np.arange(24, dtype=float).reshape(12, 2)
+        actual = preprocess.lag_matrix(values, [11], 10, [1, 11])
+        self.assertEqual(actual.tolist(), [values[11 - np.arange(11)].T.reshape(-1).tolist()])
+
+
+class TestAlignPart(unittest.TestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(1)
+        dates = [day_to_date(date_to_day('2018-01-01') + i) for i in range(40)]
+        values = random.normal(size=(40, 3))
+        values[[3, 17], 1] = np.nan
+        self.frame = SymbolFrame.from_dict({
+            date: {column: value for column, value in zip(['c', 'a', 'b'], row.tolist())}
+            for date, row in zip(dates, values)
+        })
+        self.trades = {date: float(random.uniform(-1, 1)) for date in dates[1:-3]}
+        self.trades['2019-01-01'] = 1.0
+
+    # filter_matching, the dict prior days builder and json_to_matrix, as
+    # get_symbol_part used to, keeping the days with a full history
+    def legacy_part(self, days):
+        symbol_data = filter_incomplete(self.frame.to_dict())
+        data_in, data_out = filter_matching(symbol_data, self.trades)
+        dates = sorted(symbol_data)
+        kept = [date for date in sorted(data_in) if dates.index(date) >= days]
+        matrix_in = json_to_matrix(prior_days_reference(kept, days, symbol_data))
+        matrix_out = json_to_matrix({date: data_out[date] for date in kept})
+        return matrix_in, matrix_out
+
+    def check_days(self, days):
+        labels = SymbolFrame.from_series(self.trades, 'label')
+        values, positions, out, columns = preprocess.align_part(self.frame, labels, days)
+        matrix_in, matrix_out = self.legacy_part(days)
+        inputs = preprocess.get_legacy_input_order(columns, days, columns)
+        self.assertEqual(preprocess.lag_matrix(values, positions, days, columns, inputs).tolist(), matrix_in.tolist())
+        self.assertEqual(out.tolist(), matrix_out.tolist())
+
+    def test_same_as_dicts(self):
+        for days in [0, 1, 5, 11]:
+            self.check_days(days)
+
+    def test_no_matches(self):
+        labels = SymbolFrame.from_series({'2019-01-01': 1.0}, 'label')
+        values, positions, out, columns = preprocess.align_part(self.frame, labels, 2)
+        self.assertEqual((values.shape, len(positions), len(out)), ((0, 3), 0, 0))
+
+
+class TestWindowedPart(unittest.TestCase):
+
+    def setUp(self):
+        self.columns = ['a', 'b']
+        self.bases = {
+            symbol: (np.arange(rows * 2, dtype=float).reshape(rows, 2) + 100 * i,
+                     np.arange(2, rows), np.arange(2, rows) * 0.1, self.columns)
+            for i, (symbol, rows) in enumerate([('A', 5), ('B', 8)])
+        }
+        self.part = preprocess.get_windowed_part(self.bases, 2)
+
+    def test_materialize(self):
+        matrix_in, matrix_out = self.part.materialize()
+        expected = np.concatenate([preprocess.lag_matrix(values, positions, 2, columns)
+                                   for values, positions, _, columns in self.bases.values()])
+        self.assertEqual(matrix_in.tolist(), expected.tolist())
+        self.assertEqual(matrix_out.shape, (9,))
+        self.assertEqual(self.part.get_shape(), 6)
+
+    def test_batches(self):
+        batches = list(self.part.iterate_batches(4, shuffle=True))
+        self.assertEqual([len(batch_out) for _, batch_out in batches], [4, 4, 1])
+        rows = sorted(map(tuple, np.concatenate([batch_in for batch_in, _ in batches]).tolist()))
+        self.assertEqual(rows, sorted(map(tuple, self.part.materialize()[0].tolist())))
+
+    def test_read_write(self):
+        with tempfile.TemporaryDirectory() as folder:
+            preprocess.write_data_part(folder, {'training': self.part}, 'training', None)
+            part = preprocess.read_preprocess_part(folder, 'training')
+            self.assertEqual(part.materialize()[0].tolist(), self.part.materialize()[0].tolist())
+            self.assertEqual(read_manifest(os.path.join(folder, 'training'))['inputs'],
+                             [[column, prior] for column in self.columns for prior in range(3)])
+
+
+class TestShardedPart(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.shard_rows = preprocess.SHARD_ROWS
+        preprocess.SHARD_ROWS = 4
+        self.matrix_in = np.arange(30, dtype=float).reshape(10, 3)
+        self.matrix_out = np.arange(10, dtype=float)
+        self.inputs = preprocess.get_input_order(['a'], 2)
+
+    def tearDown(self):
+        preprocess.SHARD_ROWS = self.shard_rows
+        remove_folder(self.folder)
+
+    def test_read_write(self):
+        preprocess.write_data_part(self.folder, {'training': (self.matrix_in, self.matrix_out)}, 'training',
+                                   self.inputs)
+        self.assertEqual(len(os.listdir(os.path.join(self.folder, 'training'))), 7)
+        part = preprocess.read_preprocess_part(self.folder, 'training')
+        self.assertIsInstance(part.shards[0][0], np.memmap)
+        self.assertEqual((len(part), part.get_shape()), (10, 3))
+        matrix_in, matrix_out = part.materialize()
+        self.assertEqual(matrix_in.tolist(), self.matrix_in.tolist())
+        self.assertEqual(matrix_out.tolist(), self.matrix_out.tolist())
+
+    def test_batches(self):
+        preprocess.write_data_part(self.folder, {'training': (self.matrix_in, self.matrix_out)}, 'training',
+                                   self.inputs)
+        part = preprocess.read_preprocess_part(self.folder, 'training')
+        batches = list(part.iterate_batches(3, shuffle=True))
+        self.assertEqual(sorted(np.concatenate([out for _, out in batches]).tolist()), self.matrix_out.tolist())
+        for batch_in, batch_out in batches:
+            self.assertEqual(batch_in[:, 0].tolist(), (batch_out * 3).tolist())
+
+    def test_missing(self):
+        self.assertIsNone(preprocess.read_preprocess_part(self.folder, 'training'))
+
+    def test_migrate_pickle(self):
+        write_pickle(os.path.join(self.folder, 'training.pkl'), {'in': self.matrix_in, 'out': self.matrix_out})
+        self.assertIsNone(preprocess.read_preprocess_part(self.folder, 'training'))
+        inputs = preprocess.get_legacy_input_order(['a'], 2, ['a'])
+        part = preprocess.read_preprocess_part(self.folder, 'training', inputs)
+        self.assertEqual(part.materialize()[0].tolist(), self.matrix_in.tolist())
+        self.assertEqual(read_manifest(os.path.join(self.folder, 'training'))['inputs'], [['a', 0], ['a', 1], ['a', 2]])
+
+    # parts written before the inputs order was kept are built again
+    def test_no_inputs(self):
+        preprocess.write_data_part(self.folder, {'training': (self.matrix_in, self.matrix_out)}, 'training',
+                                   self.inputs)
+        manifest = read_manifest(os.path.join(self.folder, 'training'))
+        del manifest['inputs']
+        write_manifest(os.path.join(self.folder, 'training'), manifest)
+        self.assertIsNone(preprocess.read_preprocess_part(self.folder, 'training'))
+
+    def test_remove_kur_copy(self):
+        preprocess.write_data_part(self.folder, {'training': (self.matrix_in, self.matrix_out)}, 'training',
+                                   self.inputs)
+        write_pickle(os.path.join(self.folder, 'training.kur.pkl'), {'in': self.matrix_in, 'out': self.matrix_out})
+        self.assertEqual(len(preprocess.read_preprocess_part(self.folder, 'training')), 10)
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'training.kur.pkl')))
+
+
+class TestDataPart(unittest.TestCase):
+
+    def setUp(self):
+        self.get_symbol_part = preprocess.get_symbol_part
+        self.workers = PARAMS['workers']
+        preprocess.get_symbol_part = fake_symbol_part
+
+    def tearDown(self):
+        preprocess.get_symbol_part = self.get_symbol_part
+        PARAMS['workers'] = self.workers
+
+    def check_part(self):
+        matrix_in, matrix_out = preprocess.get_data_part(['A', 'BAD', 'CCC', 'BB'], [], None, None, 0, 0.01)
+        self.assertEqual(matrix_in.shape, (6, 2))
+        self.assertEqual(matrix_in[:, 0].tolist(), [1, 3, 3, 3, 2, 2])
+        self.assertEqual(matrix_out.tolist(), [0, 0, 1, 2, 0, 1])
+
+    def test_serial(self):
+        PARAMS['workers'] = 1
+        self.check_part()
+
+    def test_parallel(self):
+        PARAMS['workers'] = 2
+        self.check_part()
+
+    def test_failures(self):
+        PARAMS['workers'] = 1
+        parts, failures = preprocess.get_symbol_parts(['A', 'BAD'], [], None, None, 0, 0.01)
+        self.assertEqual(list(parts), ['A'])
+        self.assertEqual(failures, {'BAD': 'No data for BAD'})
+
+    def test_bug(self):
+        PARAMS['workers'] = 1
+        with self.assertRaises(TypeError):
+            preprocess.get_symbol_parts(['A', 'BUG'], [], None, None, 0, 0.01)
+
+    def test_all_failed(self):
+        PARAMS['workers'] = 1
+        with self.assertRaises(DataException):
+            preprocess.get_data_part(['BAD'], [], None, None, 0, 0.01)
+
+
 class TestAllData(unittest.TestCase):
 
     @classmethod
@@ -139,9 +1270,19 @@ class TestAllData(unittest.TestCase):
     def test_symbol_data3(self):
         data = SymbolData(symbol='AAPL', options_list=get_options_list(['sma']))
         log('refreshing data...')
-        remove_last_line(data.get_symbol_path())
+        remove_last_row(data.get_symbol_path())
         SymbolData(symbol='AAPL', options_list=get_options_list(['sma', 'ema'])).refresh_data(update_old=True)
 
+    def test_local_indicators(self):
+        options_list = get_options_list(['daily', 'sma', 'ema', 'rsi', 'macd', 'bbands'])
+        data = SymbolData(symbol='AAPL', options_list=options_list)
+        local = technical.calculate_symbol_data(data.index, data.columns, options_list[1:])
+        dates = sorted(local)[-100:]
+        for column in get_columns({d: local[d] for d in dates}):
+            for date in dates:
+                self.assertAlmostEqual(local[date][column], data.columns[column][
+                    np.searchsorted(data.index, date_to_day(date))], delta=0.01)
+
     def test_screener(self):
         log('\n\nTesting Yahoo screener...\n\n')
         yahoo('day_gainers')
@@ -0,0 +1,194 @@
+import queue
+import threading
+from utility import *
+
+EVALUATE_BATCH_SIZE = 4096
+ACTIVATIONS = {
+    # the activation and its derivative in terms of the activation's output
+    'tanh': (np.tanh, lambda output: 1 - output ** 2)
+}
+LOSSES = {
+    # the loss and its derivative with respect to the prediction
+    'mean_squared_error': (lambda prediction, truth: np.mean((prediction - truth) ** 2),
+                           lambda prediction, truth: 2 * (prediction - truth) / len(truth))
+}
+
+
+# the network model.yml describes, a dense layer of nodes and a dense output,
+# each followed by the activation, with Glorot uniform weights and zero biases
+class Network:
+
+    def __init__(self, weights, activation='tanh'):
+        self.weights = weights
+        self.activation = activation
+
+    @classmethod
+    def create(cls, shape, nodes, activation='tanh', seed=None):
+        random = np.random if seed is None else np.random.RandomState(seed)
+        def glorot(rows, columns):
+            limit = np.sqrt(6 / (rows + columns))
+            return random.uniform(-limit, limit, (rows, columns))
+        return cls({
+            'w1': glorot(shape, nodes), 'b1': np.zeros(nodes),
+            'w2': glorot(nodes, 1), 'b2': np.zeros(1)
+        }, activation)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as fh:
+            weights = {key: fh[key] for key in fh.files if key != 'activation'}
+            return cls(weights, str(fh['activation']))
+
+    def save(self, path):
+        make_path(path)
+        with open(path + '.tmp', 'wb') as fh:
+            np.savez(fh, activation=self.activation, **self.weights)
+        os.replace(path + '.tmp', path)
+
+    def forward(self, matrix):
+        activate, _ = ACTIVATIONS[self.activation]
+        hidden = activate(np.dot(matrix, self.weights['w1']) + self.weights['b1'])
+        return hidden, activate(np.dot(hidden, self.weights['w2']) + self.weights['b2'])[:, 0]
+
+    def predict(self, matrix):
+        return self.forward(np.asarray(matrix, dtype=np.float64))[1]
+
+    # the batch's loss and the gradients of every weight
+    def get_gradients(self, matrix, truth, loss):
+        _, derivative = ACTIVATIONS[self.activation]
+        get_loss, get_loss_derivative = LOSSES[loss]
+        hidden, prediction = self.forward(matrix)
+        delta_out = (get_loss_derivative(prediction, truth) * derivative(prediction))[:, None]
+        delta_hidden = np.dot(delta_out, self.weights['w2'].T) * derivative(hidden)
+        return get_loss(prediction, truth), {
+            'w1': np.dot(matrix.T, delta_hidden), 'b1': delta_hidden.sum(axis=0),
+            'w2': np.dot(hidden.T, delta_out), 'b2': delta_out.sum(axis=0)
+        }
+
+
+# Adam with the defaults kur trained with
+class Adam:
+
+    def __init__(self, learning_rate=0.001, beta1=0.9, beta2=0.999, epsilon=1e-8):
+        self.learning_rate = learning_rate
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+        self.steps = 0
+        self.moments = {}
+
+    def step(self, weights, gradients):
+        self.steps += 1
+        rate = self.learning_rate * np.sqrt(1 - self.beta2 ** self.steps) / (1 - self.beta1 ** self.steps)
+        for key, gradient in gradients.items():
+            m, v = self.moments.get(key, (0, 0))
+            m = self.beta1 * m + (1 - self.beta1) * gradient
+            v = self.beta2 * v + (1 - self.beta2) * gradient ** 2
+            self.moments[key] = (m, v)
+            weights[key] -= rate * m / (np.sqrt(v) + self.epsilon)
+
+
+# the part's batches gathered on another thread while the last one trains, as
+# WindowedPart and ShardedPart batches are built or paged in from disk
+def prefetch(batches, size=2):
+    batch_queue = queue.Queue(size)
+    done = object()
+    def produce():
+        try:
+            for batch in batches:
+                batch_queue.put(batch)
+        finally:
+            batch_queue.put(done)
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        batch = batch_queue.get()
+        if batch is done:
+            return
+        yield batch
+
+
+# one pass over the shuffled part, returning the mean loss of its rows
+def train_epoch(network, optimizer, part, batch_size, loss):
+    total = 0
+    rows = 0
+    for matrix_in, matrix_out in prefetch(part.iterate_batches(batch_size, shuffle=True)):
+        batch_loss, gradients = network.get_gradients(np.asarray(matrix_in, dtype=np.float64),
+                                                      np.asarray(matrix_out, dtype=np.float64), loss)
+        optimizer.step(network.weights, gradients)
+        total += batch_loss * len(matrix_out)
+        rows += len(matrix_out)
+    return total / max(rows, 1)
+
+
+# the predictions and labels of every row of the part, in large batches
+def evaluate(network, part):
+    predictions = []
+    truth = []
+    for matrix_in, matrix_out in prefetch(part.iterate_batches(EVALUATE_BATCH_SIZE)):
+        predictions.append(network.predict(matrix_in))
+        truth.append(np.asarray(matrix_out, dtype=np.float64))
+    if not predictions:
+        return np.zeros(0), np.zeros(0)
+    return np.concatenate(predictions), np.concatenate(truth)
+
+
+def get_loss(network, part, loss):
+    predictions, truth = evaluate(network, part)
+    return float(LOSSES[loss][0](predictions, truth)) if len(truth) else np.nan
+
+
+# trains a network on the parts, returning it with the loss of the training and
+# validation parts after every epoch and the evaluation output in the
+# { truth: { out }, result: { out } } form kur wrote; every epoch is saved to the
+# checkpoint, which a later call resumes from, and with patience training stops
+# once that many epochs pass without a lower validation loss, keeping the
+# weights of the best one
+def train(parts, shape, epochs, nodes, activation, loss, batch_size, checkpoint_path=None, patience=0):
+    state = read_checkpoint(checkpoint_path) or new_state(shape, nodes, activation)
+    network = Network(state['weights'], activation)
+    optimizer = Adam()
+    optimizer.steps, optimizer.moments = state['steps'], state['moments']
+    training_loss, validation_loss = state['training_loss'], state['validation_loss']
+    if training_loss:
+        log('Resuming from epoch %s...' % len(training_loss))
+    while len(training_loss) < epochs and not should_stop(state, patience):
+        training_loss.append(train_epoch(network, optimizer, parts['training'], batch_size, loss))
+        validation_loss.append(get_loss(network, parts['validation'], loss))
+        log('Epoch %s/%s: training loss %.6f, validation loss %.6f'
+            % (len(training_loss), epochs, training_loss[-1], validation_loss[-1]))
+        if validation_loss[-1] < min(validation_loss[:-1], default=np.inf):
+            state['best_epoch'] = len(validation_loss) - 1
+            state['best_weights'] = {key: weights.copy() for key, weights in network.weights.items()}
+        state['steps'] = optimizer.steps
+        write_checkpoint(checkpoint_path, state)
+    if patience and state['best_weights']:
+        network = Network(state['best_weights'], activation)
+    result, truth = evaluate(network, parts['evaluation'])
+    return network, {
+        'training_loss': np.array(training_loss),
+        'validation_loss': np.array(validation_loss),
+        'output': {'truth': {'out': truth}, 'result': {'out': result}}
+    }
+
+
+def new_state(shape, nodes, activation):
+    return {'weights': Network.create(shape, nodes, activation).weights, 'steps': 0, 'moments': {},
+            'training_loss': [], 'validation_loss': [], 'best_epoch': None, 'best_weights': None}
+
+
+def should_stop(state, patience):
+    return bool(patience) and state['best_epoch'] is not None \
+        and len(state['validation_loss']) - 1 - state['best_epoch'] >= patience
+
+
+def read_checkpoint(path):
+    return read_pickle(path) if path else None
+
+
+# the weights and the optimizer's moments are updated in place, so the state
+# holds the current ones
+def write_checkpoint(path, state):
+    if path:
+        make_path(path)
+        write_pickle(path + '.tmp', state)
+        os.replace(path + '.tmp', path)
@@ -10,7 +10,8 @@ from binascii import hexlify, unhexlify
 import os
 from Crypto.Cipher import AES
 from params import PARAMS
-from screener import yahoo
+from schema import get_schema
+from screener import get_screener_symbols
 
 DATE_LENGTH = 10
 CRYPT_KEY = '1234567890123456'
@@ -28,6 +29,16 @@ def log(*args, force=False, **kwargs):
         print(*args, **kwargs)
 
 
+# the last line of the error, which is the message itself when it carries the
+# traceback Data adds
+def get_error_message(e):
+    return str(e).strip().split('\n')[-1]
+
+
+def log_skip(name, e):
+    log('Skipping %s: %s' % (name, get_error_message(e)), force=True)
+
+
 def set_verbosity(verbose):
     PARAMS['verbose'] = verbose or PARAMS['verbose']
 
@@ -36,6 +47,11 @@ def shorten_path(path):
     return str(sha1(path.encode('utf-8')).hexdigest())
 
 
+# sha1 of the canonical JSON of d, which names the folders data is cached in
+def fingerprint(d):
+    return sha1(json.dumps(d, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
 def make_path(path):
     dir_name = os.path.dirname(path)
     if not os.path.exists(dir_name):
@@ -129,19 +145,18 @@ def remove_duplicates(l):
     return [i for n, i in enumerate(l) if i not in l[:n]]
 
 
-def encrypt_options(options):
-    return [(column, encrypt_dict({**options, **{'column': column}}))
-            for column in options['columns']]
+def get_column_ids(options):
+    schema = get_schema()
+    return [(column, schema.get_id(options, column)) for column in options['columns']]
 
 
-def encrypt_options_list(options_list):
-    return [column for options in options_list for column in encrypt_options(options)]
+def get_column_ids_list(options_list):
+    return [column for options in options_list for column in get_column_ids(options)]
 
 
-def get_close_crypt():
+def get_close_id():
     daily_options = PARAMS['data_options']['daily']()
-    daily_crypt = encrypt_options(daily_options)
-    return [col for col in daily_crypt if 'close' in col][0][1]
+    return get_schema().get_id(daily_options, 'close')
 
 
 def filter_columns(keep, data):
@@ -167,6 +182,20 @@ def to_date(date):
     return datetime.strptime(date, '%Y-%m-%d')
 
 
+def date_to_day(date):
+    return Date(int(date[:4]), int(date[5:7]), int(date[8:10])).toordinal()
+
+
+# date_to_day for a whole list of dates at once
+def dates_to_days(dates):
+    epoch = Date(1970, 1, 1).toordinal()
+    return np.array(dates, dtype='datetime64[D]').astype(np.int64) + epoch
+
+
+def day_to_date(day):
+    return Date.fromordinal(int(day)).isoformat()
+
+
 # inclusive
 def date_between(date, start, end):
     date = to_date(date)
@@ -182,8 +211,8 @@ def filter_dates(data, start, end):
 
 
 def filter_close(data):
-    close_hash = get_close_crypt()
-    return {date: float(columns[close_hash]) for date, columns in data.items()}
+    close_id = get_close_id()
+    return {date: float(columns[close_id]) for date, columns in data.items()}
 
 
 def get_columns(data):
@@ -213,7 +242,7 @@ def dicts_to_xys(dicts):
 def get_symbols(symbols, screener, limit):
     symbols = symbols or []
     if screener:
-        symbols += yahoo(screener)
+        symbols += get_screener_symbols(screener)
     return symbols[:limit]
 
 